@@ -1,6 +1,6 @@
 # Exposing the core API to allow using via python-code (not just via CLI)
 
-from . import processing, runtime_config
+from . import processing, runtime_config, service_days
 
 def process_with_config(in_dir,
             out_dir,
@@ -9,15 +9,53 @@ def process_with_config(in_dir,
             remove_existing_files=False,
             sorted_io=False,
             itineraries=False,
+            similarity_cache_path=None,
+            service_window=None,
             ):
-    runtime_config.apply(config_override)
-    processing.process(
+    """
+    config_override replaces options of config.py for this call only, as in the -c option. service_window restricts
+    the days of service converted to a range of dates, given as 'START:END' (YYYYMMDD).
+    Returns a dict of the time and memory taken by each processing stage, and of counters of the work done, as written
+    by --profile-report.
+    """
+    run_config = runtime_config.load(config_override)
+    if isinstance(service_window, str):
+        service_window = service_days.parse_window(service_window)
+    report = processing.process(
         in_dir=in_dir,
         out_dir=out_dir,
         use_simplify_linear=use_simplify_linear,
         remove_existing_files=remove_existing_files,
         sorted_io=sorted_io,
-        itineraries=itineraries
+        itineraries=itineraries,
+        similarity_cache_path=similarity_cache_path,
+        service_window=service_window,
+        run_config=run_config
     )
+    return report.to_dict()
 
-__all__ = ["process_with_config"]
+def sweep_configs(in_dir,
+            config_overrides,
+            use_simplify_linear=False,
+            itineraries=False,
+            service_window=None,
+            ):
+    """
+    Processes the feed with each of config_overrides (a list, or a dict mapping names to config overrides), loading it
+    only once, and without writing it. Returns a list of summaries of the continuations which each configuration would
+    export, see sweep.sweep.
+    """
+    # Imported here so that python -m blocks_to_transfers.sweep doesn't find it already imported
+    from . import sweep
+
+    if isinstance(service_window, str):
+        service_window = service_days.parse_window(service_window)
+    return sweep.sweep(
+        in_dir=in_dir,
+        config_overrides=config_overrides,
+        use_simplify_linear=use_simplify_linear,
+        itineraries=itineraries,
+        service_window=service_window
+    )
+
+__all__ = ["process_with_config", "sweep_configs"]
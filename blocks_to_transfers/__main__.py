@@ -1,9 +1,10 @@
 import argparse
+import contextlib
 import os
 import json
 import sys
 import gtfs_loader
-from . import config, classify_transfers, logs, runtime_config, processing
+from . import classify_transfers, instrumentation, logs, runtime_config, processing, service_days
 
 
 def main():
@@ -24,6 +25,38 @@ def main():
         '--itineraries',
         action='store_true',
         help='Load and export Transit itinerary_cells.txt format instead of stop_times.txt.')
+    cmd.add_argument(
+        '--similarity-cache',
+        metavar='PATH',
+        help='Keep shape similarity results in this file, and reuse them in later runs')
+    cmd.add_argument(
+        '--service-window',
+        type=service_days.parse_window,
+        metavar='START:END',
+        help='Only convert days of service between these two dates (YYYYMMDD, both included)')
+    cmd.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        help='Number of processes used to convert blocks (same as the Performance.jobs option)')
+    cmd.add_argument(
+        '--warnings',
+        metavar='PATH',
+        help='Write warnings to this file once processing ends instead of printing them, as JSON Lines if PATH ends in .jsonl')
+    cmd.add_argument(
+        '--max-warnings-per-code',
+        type=int,
+        metavar='N',
+        help='Only show the first N warnings of each kind, and summarize the others')
+    cmd.add_argument(
+        '--profile-report',
+        metavar='PATH',
+        help='Write the time and memory taken by each stage, and counters of the work done, to this JSON file')
+    cmd.add_argument(
+        '--profile',
+        metavar='PATH',
+        help='Profile the main process with cProfile, writing statistics to PATH and a summary of the slowest '
+        'functions and of hot loop counters next to it, ending in .txt')
     cmd.add_argument(
         '-c',
         '--config',
@@ -37,22 +70,61 @@ def main():
         debugpy.listen(5678)
         debugpy.wait_for_client()
 
-    runtime_config.apply(json.loads(args.config))
+    config_override = json.loads(args.config)
+    config_override.setdefault('Performance', {}).update(performance_overrides(args))
+
+    try:
+        run_config = runtime_config.load(config_override)
+    except (runtime_config.InvalidConfigError, classify_transfers.InvalidRuleError) as exc:
+        print(f'Error: {type(exc).__name__}: {exc}')
+        sys.exit(1)
+
+    if args.warnings:
+        logs.Warn.sink = logs.BufferedSink(args.warnings,
+                                           args.max_warnings_per_code)
+    else:
+        logs.Warn.sink = logs.PrintSink(args.max_warnings_per_code)
+
+    if args.profile:
+        profile = instrumentation.profile(args.profile)
+    else:
+        profile = contextlib.nullcontext()
 
     try:
-        processing.process(args.feed,
-                args.out_dir,
-                use_simplify_linear=args.linear,
-                remove_existing_files=args.remove_existing_files,
-                itineraries=args.itineraries)
-    except (gtfs_loader.ParseError, classify_transfers.InvalidRuleError) as exc:
+        with profile:
+            report = processing.process(args.feed,
+                    args.out_dir,
+                    use_simplify_linear=args.linear,
+                    remove_existing_files=args.remove_existing_files,
+                    itineraries=args.itineraries,
+                    similarity_cache_path=args.similarity_cache,
+                    service_window=args.service_window,
+                    run_config=run_config)
+    except gtfs_loader.ParseError as exc:
         # Skip backtrace for common issues which indicate data or config issues
         print(f'Error: {type(exc).__name__}: {exc}')
         sys.exit(1)
+    finally:
+        logs.Warn.sink.close()
+
+    if args.profile_report:
+        report.write(args.profile_report)
 
     if logs.Warn.any_warnings:
         sys.exit(2)
 
 
+def performance_overrides(args):
+    """
+    Options of the Performance section set by command line arguments, which take precedence over --config.
+    """
+    overrides = {}
+    if args.jobs is not None:
+        overrides['jobs'] = args.jobs
+    if args.profile:
+        overrides['hot_counters'] = True
+    return overrides
+
+
 if __name__ == '__main__':
     main()
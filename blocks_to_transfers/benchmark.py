@@ -0,0 +1,134 @@
+"""
+Benchmarks the processing of synthetic feeds (see synthetic_feed.py) of increasing size, and compares the time and
+memory taken by each stage, and the counters of work done, with a baseline. Each run is a separate process, with linear
+simplification so that every stage is measured.
+
+Usage: python -m blocks_to_transfers.benchmark [--presets small medium huge] [--baseline FILE] [--update-baseline]
+                                               [--threshold 0.25] [--repeat N] [--work-dir DIR]
+
+Exits with status 1 if any measure exceeds the baseline by more than the threshold.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from . import synthetic_feed
+
+MIN_STAGE_TIME = 0.1  # s, shorter stages are too noisy to compare
+
+
+def run_preset(preset, work_dir, repeat, seed=0):
+    feed_dir = os.path.join(work_dir, f'{preset}-{seed}')
+    out_dir = os.path.join(work_dir, f'{preset}-{seed}-out')
+    report_path = os.path.join(work_dir, f'{preset}-{seed}-report.json')
+    ensure_feed(feed_dir, synthetic_feed.PRESETS[preset], seed)
+
+    reports = []
+    for _ in range(repeat):
+        completed = subprocess.run([
+            sys.executable, '-m', 'blocks_to_transfers', '--linear', '--remove-existing-files',
+            '--max-warnings-per-code', '0', '--profile-report', report_path, feed_dir, out_dir
+        ],
+                                   stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.PIPE,
+                                   text=True)
+        if completed.returncode not in (0, 2):  # 2: completed with warnings
+            raise RuntimeError(f'Processing {preset} failed:\n{completed.stderr}')
+
+        with open(report_path) as f:
+            reports.append(json.load(f))
+
+    # Keep the fastest time of each stage, which is the least disturbed by other activity
+    return {
+        'wall_time_s': min(report['wall_time_s'] for report in reports),
+        'peak_rss_mb': max(stage.get('peak_rss_mb', 0) for report in reports for stage in report['stages']),
+        'stages': {
+            stage['name']: min(other_stage['wall_time_s']
+                               for report in reports
+                               for other_stage in report['stages']
+                               if other_stage['name'] == stage['name'])
+            for stage in reports[0]['stages']
+        },
+        'counters': reports[0]['counters'],
+    }
+
+
+def ensure_feed(feed_dir, params, seed):
+    """
+    Generates the feed unless it was already generated with the same parameters.
+    """
+    params_path = os.path.join(feed_dir, 'params.json')
+    params_desc = {**params._asdict(), 'seed': seed}
+    if os.path.exists(params_path):
+        with open(params_path) as f:
+            if json.load(f) == params_desc:
+                return
+
+    print(f'Generating {feed_dir}')
+    synthetic_feed.generate(feed_dir, params, seed)
+    with open(params_path, 'w') as f:
+        json.dump(params_desc, f)
+
+
+def find_regressions(baseline, results, threshold):
+    """
+    Yields (preset, measure, baseline value, current value) for each measure which grew by more than threshold.
+    """
+    for preset, result in results.items():
+        expected = baseline.get(preset)
+        if not expected:
+            continue
+
+        measures = [('wall_time_s', expected['wall_time_s'], result['wall_time_s']),
+                    ('peak_rss_mb', expected['peak_rss_mb'], result['peak_rss_mb'])]
+        measures.extend((f'stages.{name}', value, result['stages'].get(name, 0))
+                        for name, value in expected['stages'].items()
+                        if value >= MIN_STAGE_TIME)
+        measures.extend((f'counters.{name}', value, result['counters'].get(name, 0))
+                        for name, value in expected['counters'].items())
+
+        for measure, expected_value, value in measures:
+            if value > expected_value * (1 + threshold):
+                yield preset, measure, expected_value, value
+
+
+def main():
+    cmd = argparse.ArgumentParser(description='Benchmarks processing of synthetic feeds against a baseline')
+    cmd.add_argument('--presets', nargs='+', choices=synthetic_feed.PRESETS, default=['small', 'medium'])
+    cmd.add_argument('--baseline', default='benchmark_baseline.json', help='JSON file of previous results')
+    cmd.add_argument('--update-baseline', action='store_true', help='Save the results of this run as the baseline')
+    cmd.add_argument('--threshold', type=float, default=0.25, help='Relative growth flagged as a regression')
+    cmd.add_argument('--repeat', type=int, default=1, help='Number of runs of each preset, keeping the fastest')
+    cmd.add_argument('--work-dir', help='Directory to keep the generated feeds in (default: a temporary directory)')
+    args = cmd.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = args.work_dir or temp_dir
+        results = {}
+        for preset in args.presets:
+            results[preset] = result = run_preset(preset, work_dir, args.repeat)
+            stage_times = ', '.join(f'{name} {time:.2f}s' for name, time in result['stages'].items())
+            print(f'{preset}: {result["wall_time_s"]:.2f}s, {result["peak_rss_mb"]:.0f} MB peak RSS ({stage_times})')
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    regressions = list(find_regressions(baseline, results, args.threshold))
+    for preset, measure, expected_value, value in regressions:
+        print(f'Regression: {preset} {measure} {expected_value} -> {value} (+{value / expected_value - 1:.0%})')
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({**baseline, **results}, f, indent=2)
+        print(f'Saved baseline to {args.baseline}')
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,10 +7,8 @@ predict whether a transfer is most likely to be of type:
 """
 import collections
 from enum import Enum
-from dataclasses import dataclass
-from typing import Optional
 from gtfs_loader.schema import DAY_SEC, TransferType
-from . import config, shape_similarity
+from . import instrumentation, projection, runtime_config, shape_similarity
 
 class Operation(str, Enum):
     # Change the transfer_type
@@ -24,77 +22,273 @@ class Operation(str, Enum):
 
 
 class ShapeMatchState:
+    """
+    Representatives of the stop shapes of trips, and the results of comparing them using the similarity options of
+    run_config. May be shared by configurations with the same similarity_params.
+    """
 
-    def __init__(self):
+    def __init__(self, similarity_cache=None, feed_projection=None, run_config=None):
+        self.run_config = run_config or runtime_config.load()
         self.shape_ptr_by_trip = {}
         self.shape_ptr_by_shape = {}
         self.similarity_by_shape_ptr = {}
+        self.similarity_cache = similarity_cache
+        self.projection = feed_projection or projection.SphericalProjection()
 
 
-def classify(gtfs, transfers):
+def classify(gtfs, transfers, similarity_cache=None, feed_projection=None, run_config=None, shape_match=None):
     print('Predicting transfer_type for each identified continuation')
-    shape_match = ShapeMatchState()
+    run_config = run_config or runtime_config.load()
+    shape_match = shape_match or ShapeMatchState(similarity_cache, feed_projection, run_config)
+    similarity_cache = shape_match.similarity_cache
     rule_stats = collections.Counter()
 
-    for transfer in transfers:
-        transfer.transfer_type = get_transfer_type(gtfs, shape_match, rule_stats, transfer)
+    if run_config.Performance.batch_classification:
+        heuristic_types = get_heuristic_transfer_types(run_config, gtfs, shape_match.projection, rule_stats,
+                                                       transfers)
+    else:
+        heuristic_types = None
+
+    if run_config.Performance.similarity_workers > 1:
+        precompute_similarity(run_config, gtfs, shape_match, transfers,
+                              run_config.Performance.similarity_workers, heuristic_types)
+
+    if heuristic_types is not None:
+        for transfer, transfer_type in zip(transfers, heuristic_types):
+            if transfer_type is None:
+                transfer_type = get_similarity_transfer_type(gtfs, shape_match, transfer)
+            transfer.transfer_type = transfer_type
+    else:
+        for transfer in transfers:
+            transfer.transfer_type = get_transfer_type(run_config, gtfs, shape_match, rule_stats, transfer)
 
     print(
         f'\tComparison by similarity metric required for {len(shape_match.shape_ptr_by_trip)} trips having {len(shape_match.shape_ptr_by_shape)} distinct stop_times shapes'
     )
-    print_rule_stats(rule_stats)
+    if similarity_cache:
+        print(
+            f'\tSimilarity cache: {similarity_cache.hits} hits, {similarity_cache.misses} misses'
+        )
+    print_rule_stats(run_config, rule_stats)
 
 
-def get_transfer_type(gtfs, shape_match, rule_stats, transfer):
+def get_transfer_type(run_config, gtfs, shape_match, rule_stats, transfer):
     trip = gtfs.trips[transfer.from_trip_id]
     cont_trip = gtfs.trips[transfer.to_trip_id]
 
+    transfer_type = get_heuristic_transfer_type(run_config, shape_match.projection,
+                                                rule_stats, trip, cont_trip)
+    if transfer_type is not None:
+        return transfer_type
+
+    return get_similarity_transfer_type(gtfs, shape_match, transfer)
+
+
+def get_similarity_transfer_type(gtfs, shape_match, transfer):
+    """
+    The transfer_type of a transfer which no heuristic could decide.
+    """
+    trip = gtfs.trips[transfer.from_trip_id]
+    cont_trip = gtfs.trips[transfer.to_trip_id]
+    if shape_similarity.trip_shapes_similar(
+            shape_match.similarity_by_shape_ptr,
+            get_shape_ptr(shape_match, trip),
+            get_shape_ptr(shape_match, cont_trip),
+            shape_match.run_config,
+            shape_match.similarity_cache):
+        return TransferType.VEHICLE_CONTINUATION
+
+    # We presume that the rider will be able to stay onboard the vehicle
+    return TransferType.IN_SEAT
+
+
+def get_heuristic_transfer_type(run_config, feed_projection, rule_stats, trip, cont_trip):
+    """
+    Applies every heuristic except for the similarity of shapes. Returns None
+    if the transfer_type depends on whether the shapes of trip and cont_trip
+    are similar.
+    """
     wait_time = cont_trip.first_departure - trip.last_arrival
     if cont_trip.first_departure < trip.last_arrival:
         wait_time += DAY_SEC
 
+    in_seat = run_config.InSeatTransfers
     # transfer would require riders to wait for an excessively long time
-    if wait_time > config.InSeatTransfers.max_wait_time:
+    if wait_time > in_seat.max_wait_time:
         return TransferType.VEHICLE_CONTINUATION
 
-    specified_type = get_specific_cases_result(rule_stats, trip, cont_trip)
+    specified_type = get_specific_cases_result(run_config.rule_index, rule_stats, trip, cont_trip)
     # a specific rule governs the type of this transfer
     if specified_type is not None:
         return specified_type
 
     # cont_trip resumes too far away from where trip ended (probably involves deadheading)
-    if trip.last_point.distance_to(
-            cont_trip.first_point
-    ) > config.InSeatTransfers.same_location_distance:
+    if feed_projection.distance(
+            trip.last_point, cont_trip.first_point
+    ) > in_seat.same_location_distance:
         return TransferType.VEHICLE_CONTINUATION
     
-    if config.InSeatTransfers.same_route_104:
+    if in_seat.same_route_104:
         if trip.route_id == cont_trip.route_id:
             return TransferType.IN_SEAT_TRIP_PLANNING_ONLY
 
     # trip and cont_trip form a full loop, so riders may want to stay
     # onboard despite similarity in shape.
-    if (trip.first_point.distance_to(cont_trip.first_point) <
-            config.InSeatTransfers.same_location_distance and
-            trip.last_point.distance_to(cont_trip.last_point) <
-            config.InSeatTransfers.same_location_distance):
+    if (feed_projection.distance(trip.first_point, cont_trip.first_point) <
+            in_seat.same_location_distance and
+            feed_projection.distance(trip.last_point, cont_trip.last_point) <
+            in_seat.same_location_distance):
         return TransferType.IN_SEAT
 
-    if config.InSeatTransfers.ignore_return_via_same_route:
+    if in_seat.ignore_return_via_same_route:
         if trip.route_id == cont_trip.route_id and trip.direction_id != cont_trip.direction_id:
             return TransferType.VEHICLE_CONTINUATION
 
-    if config.InSeatTransfers.ignore_return_via_similar_trip:
-        if shape_similarity.trip_shapes_similar(
-                shape_match.similarity_by_shape_ptr,
-                get_shape_ptr(shape_match, trip),
-                get_shape_ptr(shape_match, cont_trip)):
-            return TransferType.VEHICLE_CONTINUATION
+    if in_seat.ignore_return_via_similar_trip:
+        return None
 
     # We presume that the rider will be able to stay onboard the vehicle
     return TransferType.IN_SEAT
 
 
+def get_heuristic_transfer_types(run_config, gtfs, feed_projection, rule_stats, transfers):
+    """
+    Applies get_heuristic_transfer_type to every transfer, one heuristic at a time: each is evaluated over the columns
+    of values it needs for the transfers that previous heuristics left undecided. Returns the list of transfer types
+    (None where the shapes of the trips must be compared), in the order of transfers.
+    """
+    trips = [gtfs.trips[transfer.from_trip_id] for transfer in transfers]
+    cont_trips = [gtfs.trips[transfer.to_trip_id] for transfer in transfers]
+    transfer_types = [None] * len(transfers)
+    in_seat = run_config.InSeatTransfers
+    same_location_distance = in_seat.same_location_distance
+    distance = feed_projection.distance
+
+    # transfer would require riders to wait for an excessively long time
+    last_arrivals = [trip.last_arrival for trip in trips]
+    first_departures = [cont_trip.first_departure for cont_trip in cont_trips]
+    wait_times = [
+        first_departure - last_arrival + (DAY_SEC if first_departure < last_arrival else 0)
+        for first_departure, last_arrival in zip(first_departures, last_arrivals)
+    ]
+    undecided = assign_where(transfer_types, range(len(transfers)),
+                             [wait_time > in_seat.max_wait_time for wait_time in wait_times],
+                             TransferType.VEHICLE_CONTINUATION)
+
+    # a specific rule governs the type of this transfer
+    rule_index = run_config.rule_index
+    remaining = []
+    for i in undecided:
+        last_idx, specified_type = rule_index.get_result(trips[i], cont_trips[i])
+        if last_idx is None:
+            remaining.append(i)
+        else:
+            rule_stats[last_idx] += 1
+            transfer_types[i] = specified_type
+    undecided = remaining
+
+    # cont_trip resumes too far away from where trip ended (probably involves deadheading)
+    undecided = assign_where(
+        transfer_types, undecided,
+        [distance(trips[i].last_point, cont_trips[i].first_point) > same_location_distance for i in undecided],
+        TransferType.VEHICLE_CONTINUATION)
+
+    if in_seat.same_route_104:
+        undecided = assign_where(transfer_types, undecided,
+                                 [trips[i].route_id == cont_trips[i].route_id for i in undecided],
+                                 TransferType.IN_SEAT_TRIP_PLANNING_ONLY)
+
+    # trip and cont_trip form a full loop, so riders may want to stay
+    # onboard despite similarity in shape.
+    undecided = assign_where(
+        transfer_types, undecided,
+        [(distance(trips[i].first_point, cont_trips[i].first_point) < same_location_distance
+          and distance(trips[i].last_point, cont_trips[i].last_point) < same_location_distance) for i in undecided],
+        TransferType.IN_SEAT)
+
+    if in_seat.ignore_return_via_same_route:
+        undecided = assign_where(transfer_types, undecided,
+                                 [(trips[i].route_id == cont_trips[i].route_id
+                                   and trips[i].direction_id != cont_trips[i].direction_id) for i in undecided],
+                                 TransferType.VEHICLE_CONTINUATION)
+
+    if not in_seat.ignore_return_via_similar_trip:
+        # We presume that the rider will be able to stay onboard the vehicle
+        assign_where(transfer_types, undecided, [True] * len(undecided), TransferType.IN_SEAT)
+
+    return transfer_types
+
+
+def assign_where(transfer_types, indices, matches, transfer_type):
+    """
+    Assigns transfer_type to the transfers of indices where matches is true, and returns the other indices.
+    """
+    remaining = []
+    for i, match in zip(indices, matches):
+        if match:
+            transfer_types[i] = transfer_type
+        else:
+            remaining.append(i)
+    return remaining
+
+
+def precompute_similarity(run_config, gtfs, shape_match, transfers, num_workers, heuristic_types=None):
+    """
+    Compares the shapes of every pair of trips which will require it during
+    classification, using a pool of worker processes. heuristic_types, as returned by get_heuristic_transfer_types,
+    avoids applying heuristics again.
+    """
+    similarity_cache = shape_match.similarity_cache
+    pairs = {}
+
+    for i_transfer, transfer in enumerate(transfers):
+        trip = gtfs.trips[transfer.from_trip_id]
+        cont_trip = gtfs.trips[transfer.to_trip_id]
+        if heuristic_types is not None:
+            if heuristic_types[i_transfer] is not None:
+                continue
+        elif get_heuristic_transfer_type(run_config, shape_match.projection,
+                                         collections.Counter(), trip,
+                                         cont_trip) is not None:
+            continue
+
+        shape_a = get_shape_ptr(shape_match, trip)
+        shape_b = get_shape_ptr(shape_match, cont_trip)
+        if shape_a is shape_b:
+            continue
+
+        cache_key = tuple(sorted((id(shape_a), id(shape_b))))
+        if cache_key in pairs or cache_key in shape_match.similarity_by_shape_ptr:
+            continue
+
+        if similarity_cache:
+            cache_value = similarity_cache.get(shape_a, shape_b)
+            if cache_value is not None:
+                shape_match.similarity_by_shape_ptr[cache_key] = cache_value
+                continue
+
+        pairs[cache_key] = (shape_a, shape_b)
+
+    compare_pairs_parallel(shape_match, pairs, num_workers)
+
+
+def compare_pairs_parallel(shape_match, pairs, num_workers):
+    """
+    Compares pairs of shapes (by their cache key) in a pool of worker processes, storing the results in shape_match and
+    its similarity cache.
+    """
+    similarity_cache = shape_match.similarity_cache
+    print(f'\tComparing {len(pairs)} pairs of shapes using {num_workers} processes')
+    instrumentation.counters['hausdorff_computations'] += len(pairs)
+    results = shape_similarity.compute_shapes_similar_parallel(
+        list(pairs.values()), num_workers, shape_match.run_config)
+
+    for (cache_key, (shape_a, shape_b)), similar in zip(pairs.items(), results):
+        shape_match.similarity_by_shape_ptr[cache_key] = similar
+        if similarity_cache:
+            similarity_cache.put(shape_a, shape_b, similar)
+
+
 def get_shape_ptr(shape_match, trip):
     """
     For a given trip, we first check if we've already found a representative 
@@ -104,8 +298,8 @@ def get_shape_ptr(shape_match, trip):
     representative is already set for that shape. If so, we return that 
     pointer.
 
-    Otherwise, we use the trip's stop_shape object as the representative and 
-    later trips sharing the same shape will point to it.
+    Otherwise, we use the trip's stop_shape as the representative (wrapped as
+    a StopShape) and later trips sharing the same shape will point to it.
     """
 
     shape_ptr = shape_match.shape_ptr_by_trip.get(trip.trip_id)
@@ -113,8 +307,13 @@ def get_shape_ptr(shape_match, trip):
     if shape_ptr:
         return shape_ptr
 
-    shape_ptr = shape_match.shape_ptr_by_shape.setdefault(
-        trip.stop_shape, trip.stop_shape)
+    stop_shape = trip.stop_shape
+    shape_ptr = shape_match.shape_ptr_by_shape.get(stop_shape)
+    if shape_ptr is None:
+        shape_ptr = shape_match.shape_ptr_by_shape[
+            stop_shape] = shape_similarity.StopShape(
+                shape_match.projection.project(pt) for pt in stop_shape)
+
     shape_match.shape_ptr_by_trip[trip.trip_id] = shape_ptr
     return shape_ptr
 
@@ -122,91 +321,153 @@ def get_shape_ptr(shape_match, trip):
 class InvalidRuleError(Exception):
     pass
 
-def get_specific_cases_result(rule_stats, trip, cont_trip):
+
+class RuleIndex:
     """
-    Last matching rule wins. 
-    Returns None if no specific rule applies. Heuristics will be used in that case.
+    SpecialContinuations compiled into selectors on the route and last stop of the trip, and on the route and first
+    stop of its continuation, indexed by stop name (or by route for selectors without a stop). A transfer is only
+    checked against rules having a selector which could match it.
     """
-    last_idx, last_specified_type = None, None
-
-    for i, rule in enumerate(config.SpecialContinuations):
-        try:
-            specified_type = apply_specific_case(rule, trip, cont_trip)
-        except TypeError as exc:
-            raise InvalidRuleError(f'{rule}: {exc.args[0]}; ignored.') from exc
-
-        if specified_type is not None:
-            last_idx, last_specified_type = i, specified_type
 
-    if last_idx is not None:
-       rule_stats[last_idx] += 1
+    def __init__(self, rules):
+        self.rules = rules
+        self.selectors_by_rule = {}
+        self.transfer_type_by_rule = {}
+        self.rules_for_all = []
+        self.rules_by_key = collections.defaultdict(list)
+        self.result_by_names = {}
+
+        for i, rule in enumerate(rules):
+            if rule.op is not None and rule.op != Operation.MODIFY:
+                # Other operations not yet implemented
+                continue
+
+            try:
+                self.add_rule(i, rule)
+            except (TypeError, ValueError, AttributeError) as exc:
+                raise InvalidRuleError(f'{rule}: {exc.args[0]}; ignored.') from exc
+
+        for rule_ids in self.rules_by_key.values():
+            rule_ids.sort()
+
+    def add_rule(self, i, rule):
+        if not rule.match:
+            raise TypeError('no selectors')
+
+        self.transfer_type_by_rule[i] = TransferType(rule.transfer_type)
+        self.selectors_by_rule[i] = selectors = [compile_selector(selector) for selector in rule.match]
+        keys = set()
+        for selector in selectors:
+            if selector is ALL_SELECTOR:
+                self.rules_for_all.append(i)
+            elif selector[0] == 'through':
+                keys.update(selector_keys(selector[1], ('from', 'to')))
+            elif selector[1]:
+                keys.update(selector_keys(selector[1], ('from',)))
+            else:
+                keys.update(selector_keys(selector[2], ('to',)))
+
+        for key in keys:
+            self.rules_by_key[key].append(i)
+
+    def get_result(self, trip, cont_trip):
+        """
+        Returns the index and transfer_type of the last rule that matches, or (None, None).
+        """
+        names = (trip.route.route_short_name, trip.last_stop.stop_name, cont_trip.route.route_short_name,
+                 cont_trip.first_stop.stop_name)
+        result = self.result_by_names.get(names)
+        if result is None:
+            result = self.result_by_names[names] = self.find_last_match(names)
+        return result
+
+    def find_last_match(self, names):
+        from_route, from_stop, to_route, to_stop = names
+        candidates = set(self.rules_for_all)
+        for key in (('from', 'stop', from_stop), ('from', 'route', from_route), ('to', 'stop', to_stop),
+                    ('to', 'route', to_route)):
+            candidates.update(self.rules_by_key.get(key, ()))
+
+        for i in sorted(candidates, reverse=True):
+            if any(selector_matches(selector, names) for selector in self.selectors_by_rule[i]):
+                return i, self.transfer_type_by_rule[i]
+
+        return None, None
+
+
+ALL_SELECTOR = ('all',)
+
+
+def compile_selector(selector):
+    """
+    Returns ALL_SELECTOR, ('through', part) or ('from_to', from part or None, to part or None), where a part is a
+    (route short name or None, stop name or None) pair.
+    """
+    if selector.all and len(selector) == 1:
+        # "all" selectors always apply
+        return ALL_SELECTOR
 
-    return last_specified_type
+    if selector.through and len(selector) == 1:
+        # "through" selectors apply if they match either trip or cont_trip
+        return ('through', compile_part(**selector.through))
 
+    if not selector['from'] and not selector.to:
+        raise TypeError('invalid selector')
 
-def apply_specific_case(rule, trip, cont_trip):
-    if rule.op is not None and rule.op != Operation.MODIFY:
-        # Other operations not yet implemented
-        return None
+    from_part = compile_part(selector['from'].route, selector['from'].last_stop) if selector['from'] else None
+    to_part = compile_part(selector.to.route, selector.to.first_stop) if selector.to else None
+    return ('from_to', from_part, to_part)
 
-    if not rule.match:
-        raise TypeError('no selectors')
 
-    for selector in rule.match:
-        if selector_applies_to_trips(selector, trip, cont_trip):
-            return TransferType(rule.transfer_type)
+def compile_part(route=None, stop=None):
+    if route is None and stop is None:
+        raise TypeError('has no selector criteria')
 
+    return route, stop
 
-@dataclass
-class StandardSelector:
-    route: Optional[str] = None
-    stop: Optional[str] = None
 
-    def applies(self, trip, stop_to_check):
-        if self.route is None and self.stop is None:
-            raise TypeError('has no selector criteria')
+def selector_keys(part, sides):
+    route, stop = part
+    if stop is not None:
+        return [(side, 'stop', stop) for side in sides]
 
-        if self.route is not None and self.route != trip.route.route_short_name:
-            return False
+    return [(side, 'route', route) for side in sides]
 
-        if self.stop is not None and self.stop != stop_to_check.stop_name:
-            return False
 
-        return True
+def part_matches(part, route, stop):
+    return (part[0] is None or part[0] == route) and (part[1] is None or part[1] == stop)
 
 
-def selector_applies_to_trips(selector, trip, cont_trip):
-    if selector.all and len(selector) == 1:
-        # "all" selectors always apply
+def selector_matches(selector, names):
+    from_route, from_stop, to_route, to_stop = names
+    if selector is ALL_SELECTOR:
         return True
 
-    if selector.through and len(selector) == 1:
-        # "through" selectors apply if they match either trip or cont_trip
-        std_selector = StandardSelector(**selector.through)
-        return (std_selector.applies(trip, trip.last_stop)
-                or std_selector.applies(cont_trip, cont_trip.first_stop))
+    if selector[0] == 'through':
+        return part_matches(selector[1], from_route, from_stop) or part_matches(selector[1], to_route, to_stop)
 
-    if not selector['from'] and not selector.to:
-        raise TypeError('invalid selector')
+    from_part, to_part = selector[1], selector[2]
+    return ((from_part is None or part_matches(from_part, from_route, from_stop))
+            and (to_part is None or part_matches(to_part, to_route, to_stop)))
 
-    if selector['from']:
-        std_selector = StandardSelector(selector['from'].route, selector['from'].last_stop)
-        if not std_selector.applies(trip, trip.last_stop):
-            return False
 
-    if selector.to:
-        std_selector = StandardSelector(selector.to.route, selector.to.first_stop)
-        if not std_selector.applies(cont_trip, cont_trip.first_stop):
-            return False
+def get_specific_cases_result(rule_index, rule_stats, trip, cont_trip):
+    """
+    Last matching rule wins. 
+    Returns None if no specific rule applies. Heuristics will be used in that case.
+    """
+    last_idx, last_specified_type = rule_index.get_result(trip, cont_trip)
+    if last_idx is not None:
+       rule_stats[last_idx] += 1
 
-    return True
+    return last_specified_type
 
 
-def print_rule_stats(rule_stats):
+def print_rule_stats(run_config, rule_stats):
     if not rule_stats:
         return
 
     print('\tSpecial continuation rules by number of matches')
     for idx, freq in rule_stats.most_common():
-        print(f'\t\t{freq: 4d} {config.SpecialContinuations[idx]}')
+        print(f'\t\t{freq: 4d} {run_config.SpecialContinuations[idx]}')
 
@@ -57,3 +57,61 @@ SpecialContinuations = [
 #            'transfer_type': 4
 #        }
 ]
+
+
+# Controls how the work is carried out. These options affect running time, but not the output (except where noted).
+class Performance:
+    # Implementation of the similarity metric: 'python', or 'numpy' (requires numpy to be installed). The numpy engine
+    # agrees with the python engine to within 1e-6 m; only trips whose percentile distance falls within that tolerance
+    # of similarity_distance could ever be classified differently.
+    similarity_engine = 'python'
+
+    # Use a spatial index to find the nearest segment of a shape when computing the similarity metric with the python
+    # engine. Shapes are indexed once, and the result is the same as an exhaustive search.
+    similarity_index = True
+
+    # With the python engine, stop computing the similarity metric as soon as the result is certain to be above or
+    # below similarity_distance. The result is the same as computing every distance.
+    similarity_early_exit = True
+
+    # Maximum number of shape pairs kept in the file given by --similarity-cache. Least recently used pairs are evicted.
+    similarity_cache_entries = 1_000_000
+
+    # Number of worker processes used to compare the shapes of trips before classifying transfers. With 0 or 1,
+    # shapes are compared in the main process as they are needed.
+    similarity_workers = 0
+
+    # Simplify stop shapes before comparing them, removing stops which are within this fraction of similarity_distance
+    # of the simplified shape (0 disables). This CHANGES the output, if only rarely: use similarity_report.py to check
+    # how often on your feeds.
+    similarity_simplification = 0
+
+    # Project every stop onto a plane around the centre of the feed, and compute all distances (for deadheading speed,
+    # same location and similarity heuristics) using planar arithmetic. This CHANGES the output slightly: distances are
+    # off by up to 0.4% within 25 km of the centre of the feed (0.7% at latitudes above 60 degrees.)
+    planar_distances = False
+
+    # Classify transfers one heuristic at a time over all transfers, rather than one transfer at a time. The result is
+    # the same.
+    batch_classification = True
+
+    # Number of worker processes used to convert blocks (the --jobs option). With 0 or 1, blocks are converted in the
+    # main process.
+    jobs = 0
+
+    # Number of worker processes used to simplify the continuation graph, one connected component (roughly a block)
+    # at a time. With 0 or 1, components are simplified in the main process. Components are copied to and from the
+    # workers, with only their own trips and transfers, so this is only faster when components take long to simplify:
+    # see slowest_components in the report of --profile-report. The output is the same, except that with linear
+    # simplification the numbering of b2t:service_N services and the order of rows may differ, as they already do
+    # between two serial runs.
+    simplify_jobs = 0
+
+    # Representation of days of service: 'int' (sets of any width), or 'fixed' (sets no wider than the feed plus a
+    # week, which are faster to combine and iterate.) Days of service of trips departing more than a week after
+    # midnight would be truncated by 'fixed'; otherwise the output is the same.
+    day_set = 'int'
+
+    # Count events within the innermost loops (why candidate continuations are rejected, how many nodes are re-queued,
+    # how many distances the similarity metric computes...), reported by --profile-report. Enabled by --profile.
+    hot_counters = False
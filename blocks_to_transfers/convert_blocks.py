@@ -1,41 +1,187 @@
 """
 For every trip within a block, identifies valid continuation trips on each day of service.
 """
+from array import array
+import bisect
 from collections import namedtuple
 from gtfs_loader.schema import Transfer, DAY_SEC
-from . import config, service_days
+from gtfs_loader.types import GTFSTime
+from . import instrumentation, projection, runtime_config, service_days
 from .logs import Warn
 import math
+import multiprocessing
 
 BlockConvertState = namedtuple('BlockConvertState',
-                               ('gtfs', 'services', 'shape_similarity_results'))
+                               ('gtfs', 'services', 'shape_similarity_results', 'run_config'))
+
+
+class TripRecord(
+        namedtuple('TripRecord',
+                   ('trip_id', 'block_id', 'first_departure', 'last_arrival',
+                    'first_stop_name', 'last_stop_name'))):
+    """
+    A single row of the trip table, assembled to describe a trip in warnings.
+    """
+    __slots__ = ()
+
+
+class TripTable:
+    """
+    The trips within blocks, stored column by column and referred to by index. The trips of each block are contiguous
+    and sorted by departure. Times and days of service are read for every candidate continuation, so they are
+    precomputed here once per run; the remaining columns are only read once a continuation is accepted or a warning
+    is raised.
+    """
+    COLUMNS = ('trip_ids', 'block_ids', 'first_departures', 'last_arrivals',
+               'days', 'days_from_previous_day', 'first_points',
+               'last_points', 'first_stop_names', 'last_stop_names')
+
+    def __init__(self):
+        self.trip_ids = []
+        self.block_ids = []
+        self.first_departures = array('l')
+        self.last_arrivals = array('l')
+        self.days = []  # Days of service, in the trip's own frame of reference
+        self.days_from_previous_day = []  # Days of service, in the frame of a trip running the day before
+        self.first_points = []  # Projected with the feed's projection
+        self.last_points = []
+        self.first_stop_names = []
+        self.last_stop_names = []
+        self.block_ranges = []  # Indices (start, end) of the trips of each block
+
+    def __len__(self):
+        return len(self.trip_ids)
+
+    def add_block(self, trips, services, feed_projection):
+        start = len(self)
+
+        for trip in trips:
+            self.trip_ids.append(trip.trip_id)
+            self.block_ids.append(trip.block_id)
+            self.first_departures.append(trip.first_departure)
+            self.last_arrivals.append(trip.last_arrival)
+            # Shared by trips of the same service and shift, as days_by_trip is memoized
+            self.days.append(services.days_by_trip(trip))
+            self.days_from_previous_day.append(services.days_by_trip(trip, -1))
+            self.first_points.append(feed_projection.project(trip.first_point))
+            self.last_points.append(feed_projection.project(trip.last_point))
+            self.first_stop_names.append(trip.first_stop.get('stop_name'))
+            self.last_stop_names.append(trip.last_stop.get('stop_name'))
+
+        self.block_ranges.append((start, len(self)))
+
+    def block(self, i_block):
+        """
+        Copies the trips of a single block into a table of their own, compact enough to be sent to worker processes.
+        """
+        start, end = self.block_ranges[i_block]
+        table = TripTable()
+        for column in TripTable.COLUMNS:
+            setattr(table, column, getattr(self, column)[start:end])
+        table.block_ranges = [(0, end - start)]
+        return table
+
+    def record(self, i):
+        return TripRecord(self.trip_ids[i], self.block_ids[i],
+                          GTFSTime(self.first_departures[i]),
+                          GTFSTime(self.last_arrivals[i]),
+                          self.first_stop_names[i], self.last_stop_names[i])
 
 
 class TripConvertState:
 
-    def __init__(self, data, trip) -> None:
-        self.trip = trip
+    def __init__(self, table, i_trip) -> None:
+        self.i_trip = i_trip
         self.shift_days = 0
-        self.days_to_match = data.services.days_by_trip(trip)
+        self.days_to_match = table.days[i_trip]
         self.num_matches = 0
 
 
-def convert(gtfs, services, itineraries=False):
+def convert(gtfs, services, itineraries=False, feed_projection=None, run_config=None):
     print('Predicting continuation trip for trips within blocks')
-    trips_by_block = group_trips(gtfs, itineraries=itineraries)
-    converted_transfers = []
-    data = BlockConvertState(gtfs, services, {})
-
+    run_config = run_config or runtime_config.load()
+    trips_by_block = group_trips(gtfs, itineraries=itineraries, run_config=run_config)
+    feed_projection = feed_projection or projection.SphericalProjection()
+    table = TripTable()
     for trips in trips_by_block.values():
-        try:
-            converted_transfers.extend(convert_block(data, trips))
-        except Warn as exc:
-            exc.print()
+        table.add_block(trips, services, feed_projection)
+    instrumentation.counters['blocks'] += len(table.block_ranges)
+    instrumentation.counters['trips_in_blocks'] += len(table)
 
+    if run_config.Performance.jobs > 1:
+        converted_transfers = convert_parallel(services, table,
+                                               run_config.Performance.jobs, run_config)
+    else:
+        converted_transfers = []
+        data = BlockConvertState(gtfs, services, {}, run_config)
+
+        for start, end in table.block_ranges:
+            converted_transfers.extend(
+                Transfer(from_trip_id=table.trip_ids[i_trip],
+                         to_trip_id=table.trip_ids[i_cont],
+                         _rank=rank)
+                for i_trip, i_cont, rank in convert_block_or_warn(
+                    data, table, start, end))
+
+    instrumentation.counters['transfers_generated'] += len(converted_transfers)
     return converted_transfers
 
 
-def group_trips(gtfs, itineraries=False):
+def convert_parallel(services, table, num_jobs, run_config):
+    """
+    Converts blocks in a pool of worker processes. Transfers and warnings are
+    returned in the same order as if blocks were converted one after another.
+    """
+    converted_transfers = []
+    blocks = (table.block(i_block)
+              for i_block in range(len(table.block_ranges)))
+
+    with multiprocessing.Pool(num_jobs,
+                              initializer=_init_worker,
+                              initargs=(run_config,
+                                        services)) as pool:
+        for transfers, warnings, counters in pool.imap(
+                _convert_block_worker,
+                blocks,
+                chunksize=max(1,
+                              len(table.block_ranges) // (8 * num_jobs))):
+            Warn.replay(warnings)
+            instrumentation.counters.update(counters)
+            converted_transfers.extend(
+                Transfer(from_trip_id=from_trip_id,
+                         to_trip_id=to_trip_id,
+                         _rank=rank)
+                for from_trip_id, to_trip_id, rank in transfers)
+
+    return converted_transfers
+
+
+_worker_data = None
+
+
+def _init_worker(run_config, services):
+    global _worker_data
+    _worker_data = BlockConvertState(None, services, {}, run_config)
+
+
+def _convert_block_worker(table):
+    with Warn.capture() as warnings, instrumentation.capture() as counters:
+        transfers = [(table.trip_ids[i_trip], table.trip_ids[i_cont], rank)
+                     for i_trip, i_cont, rank in convert_block_or_warn(
+                         _worker_data, table, 0, len(table))]
+    return transfers, warnings, counters
+
+
+def convert_block_or_warn(data, table, start, end):
+    try:
+        return convert_block(data, table, start, end)
+    except Warn as exc:
+        exc.print()
+        return []
+
+
+def group_trips(gtfs, itineraries=False, run_config=None):
+    run_config = run_config or runtime_config.load()
     unique_shapes = {}
     trips_by_block = {}
 
@@ -45,11 +191,14 @@ def group_trips(gtfs, itineraries=False):
             continue
 
         if is_trivial_trip(trip, gtfs, itineraries=itineraries):
-            Warn(f'Trip {trip.trip_id} deleted as it has fewer than two stops.'
-                ).print()
+            Warn('Trip {trip_id} deleted as it has fewer than two stops.',
+                 code='trip_too_short',
+                 block_id=trip.block_id,
+                 trip_ids=[trip.trip_id],
+                 trip_id=trip.trip_id).print()
             continue
 
-        if config.InSeatTransfers.ignore_return_via_similar_trip:
+        if run_config.InSeatTransfers.ignore_return_via_similar_trip:
             trip.shape_ref = unique_shapes.setdefault(trip.stop_shape,
                                                       trip.stop_shape)
 
@@ -58,49 +207,74 @@ def group_trips(gtfs, itineraries=False):
     return trips_by_block
 
 
-def convert_block(data, trips):
+def convert_block(data, table, start, end):
+    """
+    Finds the continuations of the trips of the block spanning rows start to end of the table. Returns them as
+    (trip, continuation, rank) tuples, with trips given by their index in the table.
+    """
     converted_transfers = []
-
-    for i_trip, trip in enumerate(trips):
-        trip_state = TripConvertState(data, trip)
+    max_wait_time = data.run_config.TripToTripTransfers.max_wait_time
+    departures = table.first_departures
+    num_candidates = 0
+
+    for i_trip in range(start, end):
+        trip_state = TripConvertState(table, i_trip)
+        last_arrival = table.last_arrivals[i_trip]
+
+        # Trips are sorted by departure, so the continuations departing within max_wait_time form a contiguous range:
+        # following the trip on the same day, or from the first trip onwards on the next day
+        i_same_day_end = bisect.bisect_right(departures,
+                                             last_arrival + max_wait_time,
+                                             i_trip + 1, end)
+        i_next_day_end = bisect.bisect_right(
+            departures, last_arrival + max_wait_time - DAY_SEC, start, i_trip)
 
         try:
-            for cont_trip in trips[i_trip + 1:]:
-                transfer_opt = consider_transfer(data, trip_state, cont_trip)
+            for i_cont in range(i_trip + 1, i_same_day_end):
+                num_candidates += 1
+                transfer_opt = consider_transfer(data, table, trip_state,
+                                                 i_cont)
                 if transfer_opt:
                     converted_transfers.append(transfer_opt)
 
+            if i_same_day_end < end:
+                # Wait time already too long for the remaining trips of the day, and all trips of the next day
+                continue
+
             # Search continues onto the next day; shift days of service from continuation trips back one day to match
             # the notation used to describe trip
             trip_state.shift_days += 1
 
-            for cont_trip in trips[:i_trip]:
-                transfer_opt = consider_transfer(data, trip_state, cont_trip)
+            for i_cont in range(start, i_next_day_end):
+                num_candidates += 1
+                transfer_opt = consider_transfer(data, table, trip_state,
+                                                 i_cont)
                 if transfer_opt:
                     converted_transfers.append(transfer_opt)
         except StopIteration:
             # Will be raised once we know that there's no further trips to consider for transfers
-            pass
+            if data.run_config.Performance.hot_counters:
+                instrumentation.counters['trips_all_days_matched'] += 1
 
+    instrumentation.counters['candidate_pairs'] += num_candidates
     return converted_transfers
 
 
-def consider_transfer(data, trip_state, cont_trip):
-    wait_time = cont_trip.first_departure - trip_state.trip.last_arrival
-
-    if trip_state.shift_days > 0:
-        wait_time += DAY_SEC
+def consider_transfer(data, table, trip_state, i_cont):
+    i_trip = trip_state.i_trip
+    run_config = data.run_config
+    wait_time = table.first_departures[i_cont] - table.last_arrivals[i_trip]
 
     # transfer found for every day trip operates on
     if not trip_state.days_to_match:
         raise StopIteration
 
-    # Wait time too long even for operational purposes
-    if wait_time > config.TripToTripTransfers.max_wait_time:
-        raise StopIteration
-
-    cont_days_in_from_frame = data.services.days_by_trip(
-        cont_trip, -trip_state.shift_days)  # From trip's frame of reference
+    # From trip's frame of reference
+    if trip_state.shift_days > 0:
+        wait_time += DAY_SEC
+        cont_days_in_from_frame = table.days_from_previous_day[i_cont]
+    else:
+        cont_days_in_from_frame = table.days[i_cont]
 
     # Can only match on days originating trip is running
     days_when_best = cont_days_in_from_frame.intersection(
@@ -109,59 +283,78 @@ def consider_transfer(data, trip_state, cont_trip):
     # A: trip and cont_trip never run on the same day; or
     # B: There's no day cont_trip runs on that isn't served by an earlier trip
     if not days_when_best:
+        if run_config.Performance.hot_counters:
+            instrumentation.counters['candidates_no_common_days'] += 1
         return None
 
+    # Only formatted if a warning is printed
+    debug_context = service_days.LazyDates(data.services, days_when_best)
+
     # We know that trip and cont_trip operate together on at least one day, and yet there's no way a single
     # vehicle can do this.
-    if not valid_wait_time(trip_state.trip,
-                           cont_trip,
+    if not valid_wait_time(run_config.TripToTripTransfers,
+                           table,
+                           i_trip,
+                           i_cont,
                            wait_time,
-                           debug_context=data.services.pdates(days_when_best)):
+                           debug_context=debug_context):
+        if run_config.Performance.hot_counters:
+            instrumentation.counters['candidates_invalid_wait_time'] += 1
         return None
 
-    if not reasonable_deadheading_speed(
-            trip_state.trip,
-            cont_trip,
-            wait_time,
-            debug_context=data.services.pdates(days_when_best)):
+    if not reasonable_deadheading_speed(run_config.TripToTripTransfers,
+                                        table,
+                                        i_trip,
+                                        i_cont,
+                                        wait_time,
+                                        debug_context=debug_context):
+        if run_config.Performance.hot_counters:
+            instrumentation.counters['candidates_deadheading_too_fast'] += 1
         return None
 
     trip_state.days_to_match = trip_state.days_to_match.difference(
         days_when_best)
     trip_state.num_matches += 1
 
-    return Transfer(from_trip_id=trip_state.trip.trip_id,
-                    to_trip_id=cont_trip.trip_id,
-                    _rank=trip_state.num_matches)
+    return i_trip, i_cont, trip_state.num_matches
 
 
 KM_H_FACTOR = 3.6  # Conversion factor between m/s and km/h
 
 
-def reasonable_deadheading_speed(trip, cont_trip, wait_time, debug_context):
-    dist = trip.last_point.distance_to(cont_trip.first_point)
-    if dist < config.TripToTripTransfers.max_nearby_deadheading_distance:
+def reasonable_deadheading_speed(trip_to_trip, table, i_trip, i_cont, wait_time,
+                                 debug_context):
+    dist = table.last_points[i_trip].distance_to(table.first_points[i_cont])
+    if dist < trip_to_trip.max_nearby_deadheading_distance:
         return True
 
     speed = KM_H_FACTOR * dist / wait_time if wait_time else math.inf
 
-    if speed > config.TripToTripTransfers.max_deadheading_speed:
-        Warn(f'''
-        Block {trip.block_id} is invalid - attempting auto-fix:
-            | {trip.first_departure} {trip.first_stop.stop_name} [trip {trip.trip_id}]
-            v {trip.last_arrival} {trip.last_stop.stop_name} [trip {trip.trip_id}]
-            \t(!) Would require travelling {dist/1000:.2f} km at {speed:.0f} km/h (!)
-            | {cont_trip.first_departure} {cont_trip.first_stop.stop_name} [trip {cont_trip.trip_id}] 
-            v {cont_trip.last_arrival} {cont_trip.last_stop.stop_name} [trip {cont_trip.trip_id}]
+    if speed > trip_to_trip.max_deadheading_speed:
+        Warn('''
+        Block {block_id} is invalid - attempting auto-fix:
+            | {trip.first_departure} {trip.first_stop_name} [trip {trip.trip_id}]
+            v {trip.last_arrival} {trip.last_stop_name} [trip {trip.trip_id}]
+            \t(!) Would require travelling {dist_km:.2f} km at {speed:.0f} km/h (!)
+            | {cont_trip.first_departure} {cont_trip.first_stop_name} [trip {cont_trip.trip_id}] 
+            v {cont_trip.last_arrival} {cont_trip.last_stop_name} [trip {cont_trip.trip_id}]
             
-            Occurs on days {debug_context}.
-        ''').print()
+            Occurs on days {days}.
+        ''',
+             code='deadheading_too_fast',
+             block_id=table.block_ids[i_trip],
+             trip_ids=[table.trip_ids[i_trip], table.trip_ids[i_cont]],
+             days=debug_context,
+             trip=table.record(i_trip),
+             cont_trip=table.record(i_cont),
+             dist_km=dist / 1000,
+             speed=speed).print()
         return False
 
     return True
 
 
-def valid_wait_time(trip, cont_trip, wait_time, debug_context):
+def valid_wait_time(trip_to_trip, table, i_trip, i_cont, wait_time, debug_context):
 
     def trip_desc(char, trip, time):
         return f'{char} {time} [trip {trip.trip_id}]'
@@ -169,17 +362,30 @@ def valid_wait_time(trip, cont_trip, wait_time, debug_context):
     if wait_time >= 0:
         return True
 
-    action = 'attempting auto-fix' if config.TripToTripTransfers.force_allow_invalid_blocks else 'deleted'
-    block_error = Warn(f'''
-        Block {trip.block_id} is invalid - {action}:
-            {trip_desc('|', trip, trip.first_departure):<60}\t\t{trip_desc('|', cont_trip, cont_trip.first_departure):<60} 
-            {trip_desc('v', trip, trip.last_arrival):<60}\t\t{trip_desc('v', cont_trip, cont_trip.last_arrival):<60}
-            \t\t(!) In two places at once for {abs(wait_time)} s (!)
-
-            Occurs on days {debug_context}.
-    ''')
-
-    if config.TripToTripTransfers.force_allow_invalid_blocks:
+    trip, cont_trip = table.record(i_trip), table.record(i_cont)
+    action = 'attempting auto-fix' if trip_to_trip.force_allow_invalid_blocks else 'deleted'
+    block_error = Warn('''
+        Block {block_id} is invalid - {action}:
+            {trip_first:<60}\t\t{cont_first:<60} 
+            {trip_last:<60}\t\t{cont_last:<60}
+            \t\t(!) In two places at once for {overlap} s (!)
+
+            Occurs on days {days}.
+    ''',
+                       code='trips_overlap',
+                       block_id=trip.block_id,
+                       trip_ids=[trip.trip_id, cont_trip.trip_id],
+                       days=debug_context,
+                       action=action,
+                       trip_first=trip_desc('|', trip, trip.first_departure),
+                       cont_first=trip_desc('|', cont_trip,
+                                            cont_trip.first_departure),
+                       trip_last=trip_desc('v', trip, trip.last_arrival),
+                       cont_last=trip_desc('v', cont_trip,
+                                           cont_trip.last_arrival),
+                       overlap=abs(wait_time))
+
+    if trip_to_trip.force_allow_invalid_blocks:
         block_error.print()
         return False
     else:
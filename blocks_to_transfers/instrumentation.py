@@ -0,0 +1,172 @@
+"""
+Measures the time and memory taken by each stage of processing, and counts the work done within stages, so that the
+performance of a feed can be tracked from one run to the next.
+"""
+import collections
+import contextlib
+import cProfile
+import functools
+import heapq
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Work done so far, by name, for the whole process: only one feed is processed at a time, see one_run_at_a_time.
+# Reset by Report.
+counters = collections.Counter()
+# Heap of (wall_time_s, stage, first_trip_id, num_nodes) of the graph components which took the longest to simplify.
+# Reset by Report.
+slowest_components = []
+NUM_SLOWEST_COMPONENTS = 10
+run_lock = threading.Lock()
+
+
+def one_run_at_a_time(func):
+    """
+    Decorates a function processing a feed, which raises RuntimeError if it is called while another feed is processed
+    in this process (e.g. from another thread): counters, slowest components and the sink of logs.Warn are shared by
+    the whole process, so the reports and warnings of both runs would be mixed up.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not run_lock.acquire(blocking=False):
+            raise RuntimeError(f'{func.__name__} was called while another feed is processed in this process; '
+                               'use a separate process to process feeds at the same time')
+        try:
+            return func(*args, **kwargs)
+        finally:
+            run_lock.release()
+
+    return wrapper
+
+
+class Report:
+    """
+    Timings by stage, and counters. Memory is reported as the peak RSS of the process so far, and, if tracemalloc is
+    tracing (e.g. python -X tracemalloc), as the peak of memory allocated within each stage.
+    """
+
+    def __init__(self):
+        counters.clear()
+        slowest_components.clear()
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start_wall = time.perf_counter()
+        start_cpu = cpu_time()
+        if tracemalloc.is_tracing():
+            start_traced = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+
+        yield
+
+        stage = {
+            'name': name,
+            'wall_time_s': round(time.perf_counter() - start_wall, 3),
+            'cpu_time_s': round(cpu_time() - start_cpu, 3),
+        }
+        if resource:
+            stage['peak_rss_mb'] = round(peak_rss() / 1e6, 1)
+        if tracemalloc.is_tracing():
+            stage['tracemalloc_peak_mb'] = round(
+                (tracemalloc.get_traced_memory()[1] - start_traced) / 1e6, 1)
+        self.stages.append(stage)
+
+    def to_dict(self):
+        report = {
+            'wall_time_s':
+                round(sum(stage['wall_time_s'] for stage in self.stages), 3),
+            'stages': self.stages,
+            'counters': dict(sorted(counters.items())),
+        }
+        if counters['shape_comparisons']:
+            report['similarity_hit_rate'] = round(
+                1 - counters['hausdorff_computations'] /
+                counters['shape_comparisons'], 3)
+        if slowest_components:
+            report['slowest_components'] = [{
+                'stage': stage,
+                'first_trip_id': trip_id,
+                'nodes': num_nodes,
+                'wall_time_s': round(wall_time_s, 6),
+            } for wall_time_s, stage, trip_id, num_nodes in sorted(slowest_components, reverse=True)]
+        return report
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+def record_component(stage, trip_id, num_nodes, wall_time_s):
+    """
+    Keeps the time taken to simplify a connected component of the continuation graph, if it is among the slowest.
+    Components are identified by their first trip.
+    """
+    entry = (wall_time_s, stage, trip_id, num_nodes)
+    if len(slowest_components) < NUM_SLOWEST_COMPONENTS:
+        heapq.heappush(slowest_components, entry)
+    else:
+        heapq.heappushpop(slowest_components, entry)
+
+
+def cpu_time():
+    """
+    CPU time of this process and of its worker processes that have exited.
+    """
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def peak_rss():
+    # ru_maxrss is in kilobytes, except on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+@contextlib.contextmanager
+def profile(path, num_functions=40):
+    """
+    Profiles the main process with cProfile while in the context. Statistics are dumped to path, for use with pstats
+    or snakeviz, along with a text summary of counters and of the num_functions functions with the highest
+    cumulative time, in a file of the same name ending in .txt.
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+
+        with open(os.path.splitext(path)[0] + '.txt', 'w') as f:
+            f.write('Counters:\n')
+            f.writelines(f'    {name}: {count}\n'
+                         for name, count in sorted(counters.items()))
+            f.write('\n')
+            stats = pstats.Stats(profiler, stream=f)
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(
+                num_functions)
+
+
+@contextlib.contextmanager
+def capture():
+    """
+    Counts the work done within the context separately, e.g. to add it to the counters of another process.
+    """
+    captured = collections.Counter()
+    before = counters.copy()
+    try:
+        yield captured
+    finally:
+        captured.update(counters - before)
@@ -2,29 +2,216 @@
 Handles the printing of warnings generated during processing.
 """
 
-import textwrap
+import collections
+import contextlib
+import json
+import string
 import sys
 
 
+class WarningRecord(
+        collections.namedtuple(
+            'WarningRecord',
+            ('code', 'block_id', 'trip_ids', 'dates', 'message'))):
+    """
+    A formatted warning, with its dates as ISO strings.
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        return self.message
+
+    def record(self):
+        return self
+
+
 class Warn(Exception):
     N_INDENT = 4
     any_warnings = False
+    sink = None  # Where printed warnings go, for the whole process, see PrintSink and BufferedSink
 
-    def __init__(self, raw_message):
+    def __init__(self,
+                 raw_message,
+                 code='warning',
+                 block_id=None,
+                 trip_ids=(),
+                 days=None,
+                 **args):
+        """
+        raw_message is a str.format template for args, block_id, trip_ids and days. code identifies the kind of
+        warning, for rate limiting and summaries. The message is only formatted once the warning is printed, so
+        arguments should be cheap to capture, deferring expensive descriptions to their __str__.
+        """
         Warn.any_warnings = True
+        super().__init__(raw_message)
+        self.code = code
+        self.block_id = block_id
+        self.trip_ids = tuple(trip_ids)
+        self.days = days  # service_days.LazyDates
+        self.args_to_format = args
+        self.fields = None  # Values of the fields of raw_message, once detached
+        self._message = None
+
+    def __str__(self):
+        if self._message is None:
+            if self.fields is None:
+                raw_message = self.args[0].format(block_id=self.block_id,
+                                                  trip_ids=self.trip_ids,
+                                                  days=self.days,
+                                                  **self.args_to_format)
+            else:
+                raw_message = ResolvedFormatter(self.fields).format(self.args[0])
 
-        # Force standard formatting for message
-        lines = raw_message.replace(Warn.N_INDENT * ' ',
-                                    '').strip().splitlines()
-        message = [f'Warning: {lines[0]}']
-        message.extend(Warn.indent(line) for line in lines[1:])
-        message.append('')
+            # Force standard formatting for message
+            lines = raw_message.replace(Warn.N_INDENT * ' ',
+                                        '').strip().splitlines()
+            message = [f'Warning: {lines[0]}']
+            message.extend(Warn.indent(line) for line in lines[1:])
+            message.append('')
+            self._message = '\n'.join(message)
 
-        super().__init__('\n'.join(message))
+        return self._message
 
     @staticmethod
     def indent(text, level=1):
         return Warn.N_INDENT * level * ' ' + text
 
     def print(self):
-        print(str(self), file=sys.stderr)
+        Warn.sink.add(self)
+
+    def detach(self):
+        """
+        Looks up the value of each field of the message (e.g. {trip.first_departure}) without formatting it, and drops
+        the arguments. The warning then no longer refers to the objects it was raised about, and can be sent to
+        another process cheaply, to be formatted there only if it is printed.
+        """
+        if self.fields is None and self._message is None:
+            formatter = string.Formatter()
+            args = dict(block_id=self.block_id, trip_ids=self.trip_ids, days=self.days, **self.args_to_format)
+            self.fields = {
+                field_name: formatter.get_field(field_name, (), args)[0]
+                for _, field_name, _, _ in formatter.parse(self.args[0])
+                if field_name is not None
+            }
+            self.args_to_format = {}
+        return self
+
+    def record(self):
+        """
+        Formats the warning into a record, e.g. to write it as JSON.
+        """
+        return WarningRecord(self.code, self.block_id, list(self.trip_ids),
+                             self.days.dates() if self.days else [],
+                             str(self))
+
+    @staticmethod
+    @contextlib.contextmanager
+    def capture():
+        """
+        Keeps the warnings printed within the context, detached (see detach) but not formatted, e.g. to send them
+        from a worker process and print them with replay. Rate limits then apply before warnings are formatted.
+        """
+        previous_sink = Warn.sink
+        Warn.sink = CaptureSink()
+        try:
+            yield Warn.sink.records
+        finally:
+            Warn.sink = previous_sink
+
+    @staticmethod
+    def replay(records):
+        for record in records:
+            Warn.any_warnings = True
+            Warn.sink.add(record)
+
+
+class PrintSink:
+    """
+    Prints warnings to stderr as they occur. Past max_per_code warnings of the same code, warnings are only counted,
+    and a summary of the counts is printed by close().
+    """
+
+    def __init__(self, max_per_code=None):
+        self.max_per_code = max_per_code
+        self.counts = collections.Counter()
+
+    def add(self, warning):
+        self.counts[warning.code] += 1
+        if self.max_per_code is None or self.counts[
+                warning.code] <= self.max_per_code:
+            self.emit(warning)
+
+    def emit(self, warning):
+        print(str(warning), file=sys.stderr)
+
+    def num_suppressed(self, code):
+        if self.max_per_code is None:
+            return 0
+        return max(0, self.counts[code] - self.max_per_code)
+
+    def summary(self):
+        lines = ['Warnings by code:']
+        for code, count in sorted(self.counts.items()):
+            suppressed = self.num_suppressed(code)
+            lines.append(
+                Warn.indent(f'{code}: {count}' +
+                            (f' ({suppressed} not shown)' if suppressed else '')))
+        return '\n'.join(lines)
+
+    def close(self):
+        if any(self.num_suppressed(code) for code in self.counts):
+            print(self.summary(), file=sys.stderr)
+
+
+class BufferedSink(PrintSink):
+    """
+    Keeps warnings until close(), then writes them to path at once: as JSON Lines if path ends in .jsonl, or else as
+    text. Warnings past max_per_code are never formatted. A summary of the counts is printed if there were any.
+    """
+
+    def __init__(self, path, max_per_code=None):
+        super().__init__(max_per_code)
+        self.path = path
+        self.warnings = []
+
+    def emit(self, warning):
+        self.warnings.append(warning)
+
+    def close(self):
+        with open(self.path, 'w') as f:
+            if self.path.endswith('.jsonl'):
+                for warning in self.warnings:
+                    f.write(json.dumps(warning.record()._asdict()) + '\n')
+            else:
+                f.writelines(f'{warning}\n' for warning in self.warnings)
+
+        self.warnings = []
+        if self.counts:
+            print(self.summary(), file=sys.stderr)
+
+
+class CaptureSink:
+    """
+    Keeps all warnings, detached, see Warn.capture.
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def add(self, warning):
+        self.records.append(warning.detach())
+
+
+class ResolvedFormatter(string.Formatter):
+    """
+    Formats a template from the values of its fields, looked up beforehand by Warn.detach.
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def get_field(self, field_name, args, kwargs):
+        return self.fields[field_name], field_name
+
+
+Warn.sink = PrintSink()
@@ -1,35 +1,76 @@
 import gtfs_loader
 import shutil
-from . import convert_blocks, service_days, classify_transfers, simplify_fix, simplify_linear, simplify_export, set_pickup_drop_off
+from . import (convert_blocks, service_days, classify_transfers, simplify_fix, simplify_linear, simplify_export,
+               set_pickup_drop_off, projection, runtime_config)
+from .instrumentation import Report, counters, one_run_at_a_time
+from .similarity_cache import SimilarityCache
 
 
+@one_run_at_a_time
 def process(in_dir,
             out_dir,
             use_simplify_linear=False,
             remove_existing_files=False,
             sorted_io=False,
             itineraries=False,
+            similarity_cache_path=None,
+            service_window=None,
+            run_config=None,
             ):
-    gtfs = gtfs_loader.load(in_dir, sorted_read=sorted_io, itineraries=itineraries)
+    """
+    Only days of service within service_window, a pair of dates (see service_days.parse_window), are converted.
+    Options are taken from run_config (see runtime_config.load), by default the options of config.py.
+    Returns a Report of the time and memory taken by each stage, and of the work done.
+    """
+    run_config = run_config or runtime_config.load()
+    hot_counters, simplify_jobs = run_config.Performance.hot_counters, run_config.Performance.simplify_jobs
+    report = Report()
 
-    services = service_days.ServiceDays(gtfs)
-    converted_transfers = convert_blocks.convert(gtfs, services, itineraries=itineraries)
-    classify_transfers.classify(gtfs, converted_transfers)
+    with report.stage('load'):
+        gtfs = gtfs_loader.load(in_dir, sorted_read=sorted_io, itineraries=itineraries)
 
-    graph = simplify_fix.simplify(gtfs, services, converted_transfers)
+    with report.stage('service_days'):
+        services = service_days.ServiceDays(gtfs, window=service_window, day_set=run_config.Performance.day_set)
+        feed_projection = projection.for_feed(gtfs, run_config.Performance.planar_distances)
+
+    with report.stage('convert'):
+        converted_transfers = convert_blocks.convert(gtfs, services, itineraries=itineraries,
+                feed_projection=feed_projection, run_config=run_config)
+
+    with report.stage('classify'):
+        similarity_cache = SimilarityCache(similarity_cache_path,
+                run_config=run_config) if similarity_cache_path else None
+        classify_transfers.classify(gtfs, converted_transfers, similarity_cache=similarity_cache,
+                feed_projection=feed_projection, run_config=run_config)
+        if similarity_cache:
+            counters['similarity_cache_hits'] += similarity_cache.hits
+            similarity_cache.close()
+
+    with report.stage('simplify_fix'):
+        graph = simplify_fix.simplify(gtfs, services, converted_transfers, hot_counters=hot_counters,
+                jobs=simplify_jobs)
 
     if use_simplify_linear:
-        output_graph = simplify_linear.simplify(graph)
+        with report.stage('simplify_linear'):
+            output_graph = simplify_linear.simplify(graph, hot_counters=hot_counters, jobs=simplify_jobs)
     else:
         output_graph = graph
-    simplify_export.export_visit(output_graph, itineraries=itineraries)
 
-    set_pickup_drop_off.set_pickup_drop_off(gtfs, itineraries=itineraries)
+    with report.stage('export_visit'):
+        simplify_export.export_visit(output_graph, itineraries=itineraries)
+
+    with report.stage('set_pickup_drop_off'):
+        set_pickup_drop_off.set_pickup_drop_off(gtfs, itineraries=itineraries)
+
+    with report.stage('patch'):
+        if remove_existing_files:
+            shutil.rmtree(out_dir, ignore_errors=True)
 
-    if remove_existing_files:
-        shutil.rmtree(out_dir, ignore_errors=True)
+        gtfs_loader.patch(gtfs, gtfs_in_dir=in_dir, gtfs_out_dir=out_dir,
+                sorted_output=sorted_io, itineraries=itineraries)
 
-    gtfs_loader.patch(gtfs, gtfs_in_dir=in_dir, gtfs_out_dir=out_dir, 
-            sorted_output=sorted_io, itineraries=itineraries)
+    counters['service_days_cache_hits'] += services.cache_hits
+    counters['service_days_cache_misses'] += services.cache_misses
 
     print('Done.')
+    return report
@@ -0,0 +1,83 @@
+"""
+Distances between stops are normally computed on the sphere. Optionally (config.Performance.planar_distances), every
+stop of the feed is instead projected once onto a plane, so that heuristics only need cheap planar arithmetic.
+"""
+from math import cos, hypot
+from gtfs_loader.lat_lon import LatLon
+
+
+def for_feed(gtfs, planar_distances=False):
+    if planar_distances:
+        return PlanarProjection(stop.location
+                                for stop in gtfs.stops.values()
+                                if stop.location is not None)
+
+    return SphericalProjection()
+
+
+class SphericalProjection:
+    """
+    Leaves points unchanged: distances are computed on the sphere.
+    """
+
+    def project(self, pt):
+        return pt
+
+    def distance(self, a, b):
+        return a.distance_to(b)
+
+
+class PlanarProjection:
+    """
+    Equirectangular projection centred on the centroid of the feed's stops. East-west distances are scaled for the
+    latitude of the centroid, so the relative error grows with the north-south distance from it: about 0.4% at 25 km
+    from the centroid at latitude 45 (0.7% at latitude 60), and 1.6% at 100 km (2.8% at latitude 60).
+    """
+
+    def __init__(self, locations):
+        locations = list(locations)
+        self.lat_0 = sum(pt.lat for pt in locations) / len(locations) if locations else 0
+        self.lon_0 = sum(pt.lon for pt in locations) / len(locations) if locations else 0
+        self.x_scale = LatLon.EARTH_RADIUS_M * cos(self.lat_0)
+        self.points = {pt: self._project(pt) for pt in locations}
+
+    def _project(self, pt):
+        return PlanarPoint(self.x_scale * (pt.lon - self.lon_0),
+                           LatLon.EARTH_RADIUS_M * (pt.lat - self.lat_0))
+
+    def project(self, pt):
+        planar_pt = self.points.get(pt)
+        if planar_pt is None:
+            planar_pt = self.points[pt] = self._project(pt)
+        return planar_pt
+
+    def distance(self, a, b):
+        return self.project(a).distance_to(self.project(b))
+
+
+class PlanarPoint:
+    """
+    Projected point, with coordinates in metres. Provides the same distance methods as LatLon.
+    """
+    __slots__ = ('x', 'y')
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+    def __repr__(self):
+        return repr((self.x, self.y))
+
+    def distance_to(self, other):
+        return hypot(other.x - self.x, other.y - self.y)
+
+    def distance_to_segment(x, l1, l2):
+        d_x, d_y = l2.x - l1.x, l2.y - l1.y
+        length_sq = d_x * d_x + d_y * d_y
+        if length_sq == 0:
+            return x.distance_to(l1)
+
+        # Position of the point closest to x along l1-l2, as a fraction of its length
+        along = ((x.x - l1.x) * d_x + (x.y - l1.y) * d_y) / length_sq
+        along = min(max(along, 0), 1)
+        return hypot(l1.x + along * d_x - x.x, l1.y + along * d_y - x.y)
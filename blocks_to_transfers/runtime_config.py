@@ -1,27 +1,137 @@
-import json
-from . import config
+"""
+Options are read from config.py, with overrides passed at runtime, into a RuntimeConfig which is passed explicitly to
+each stage of processing, so config.py is never modified. Its options can't be modified once loaded, so several
+configurations can be used one after another in a process, and sent to worker processes.
 
+Feeds are still processed one at a time in a process: the counters of instrumentation, the report's slowest
+components and the sink of logs.Warn are shared by the whole process, and are reset or replaced by each run. A run
+started while another is in progress raises RuntimeError (see instrumentation.one_run_at_a_time).
+"""
+import numbers
+from . import classify_transfers, config
 
-def apply(config_override):
+SECTIONS = ('TripToTripTransfers', 'InSeatTransfers', 'Performance')
+
+# Options which only accept a few values
+CHOICES = {
+    ('Performance', 'similarity_engine'): ('python', 'numpy'),
+    ('Performance', 'day_set'): ('int', 'fixed'),
+}
+
+
+class InvalidConfigError(Exception):
+    pass
+
+
+class Section:
     """
-    Applies configuration options passed at runtime
+    The options of one section of config.py, read-only. Sections with the same options are equal, so that results
+    depending on a single section can be shared between configurations.
+    """
+
+    def __init__(self, options):
+        self.__dict__.update(options)
+
+    def __setattr__(self, k, v):
+        raise AttributeError(f'Cannot set {k}: runtime configuration is read-only')
+
+    def __delattr__(self, k):
+        raise AttributeError(f'Cannot delete {k}: runtime configuration is read-only')
+
+    def __eq__(self, other):
+        return isinstance(other, Section) and vars(self) == vars(other)
+
+    def __hash__(self):
+        return hash(tuple(sorted(vars(self).items())))
+
+    def __repr__(self):
+        return f'Section({vars(self)})'
+
+
+class RuntimeConfig:
+    """
+    Every option of config.py, as sections of the same name. Values derived from the options are computed once:
+
+    rule_index: SpecialContinuations, including the rules added for banned_stops, compiled by
+        classify_transfers.RuleIndex. It memoizes the rule matching each combination of routes and stops, the only
+        state of a RuntimeConfig which changes after it is loaded; the result only depends on the rules.
+    similarity_params: options which affect the result of shape_similarity.compute_shapes_similar
+    similarity_tolerance: distance within which stops are removed from shapes by similarity_simplification (m)
     """
-    for section, options in config_override.items():
-        if section == 'SpecialContinuations':
-            # This section is a list
-            config.__dict__[section] = options
-        else:
-            # Other sections are dicts
-            for k, v in options.items():
-                setattr(config.__dict__[section], k, v)
 
-    for stop in config.InSeatTransfers.banned_stops:
-        config.SpecialContinuations.append({
+    def __init__(self, sections, special_continuations):
+        for name, section in sections.items():
+            self.__dict__[name] = section
+
+        in_seat, performance = self.InSeatTransfers, self.Performance
+        banned_stop_rules = [{
             'match': [{'through': {'stop': stop}}],
             'op': 'modify',
-            'transfer_type': 5})
+            'transfer_type': 5
+        } for stop in in_seat.banned_stops]
+        self.__dict__.update(
+            SpecialContinuations=tuple(GetDict.convert_rec(list(special_continuations) + banned_stop_rules)),
+            similarity_params=(in_seat.similarity_percentile, in_seat.similarity_distance,
+                               performance.similarity_simplification, performance.planar_distances),
+            similarity_tolerance=performance.similarity_simplification * in_seat.similarity_distance)
+        self.__dict__['rule_index'] = classify_transfers.RuleIndex(self.SpecialContinuations)
+
+    def __setattr__(self, k, v):
+        raise AttributeError(f'Cannot set {k}: runtime configuration is read-only')
+
+    def __delattr__(self, k):
+        raise AttributeError(f'Cannot delete {k}: runtime configuration is read-only')
+
+
+def load(config_override=None):
+    """
+    Returns the options of config.py, with the sections of config_override (as in the -c option) replacing them.
+    Raises InvalidConfigError if an option doesn't exist or has a value of the wrong type, or InvalidRuleError if a
+    special continuation is invalid.
+    """
+    config_override = config_override or {}
+    for section in config_override:
+        if section not in SECTIONS and section != 'SpecialContinuations':
+            raise InvalidConfigError(f'Unknown section {section}')
+
+    sections = {}
+    for name in SECTIONS:
+        defaults = {k: v for k, v in vars(getattr(config, name)).items() if not k.startswith('_')}
+        options = dict(defaults)
+        for k, v in config_override.get(name, {}).items():
+            if k not in defaults:
+                raise InvalidConfigError(f'Unknown option {name}.{k}')
+
+            check_value(name, k, v, defaults[k])
+            options[k] = v
+
+        # Lists are converted to tuples so that sections can be compared and hashed
+        sections[name] = Section({k: tuple(v) if isinstance(v, list) else v for k, v in options.items()})
+
+    special_continuations = config_override.get('SpecialContinuations', config.SpecialContinuations)
+    if not isinstance(special_continuations, list):
+        raise InvalidConfigError('SpecialContinuations must be a list')
+
+    return RuntimeConfig(sections, special_continuations)
+
+
+def check_value(section, k, v, default):
+    choices = CHOICES.get((section, k))
+    if choices:
+        if v not in choices:
+            raise InvalidConfigError(f'{section}.{k} must be one of {", ".join(choices)}, not {v!r}')
+        return
+
+    if isinstance(default, bool):
+        valid = isinstance(v, bool)
+    elif isinstance(default, numbers.Number):
+        valid = isinstance(v, numbers.Number) and not isinstance(v, bool)
+    else:
+        valid = isinstance(v, type(default))
+
+    if not valid:
+        raise InvalidConfigError(f'{section}.{k} must be of type {type(default).__name__}, not {v!r}')
 
-    config.SpecialContinuations = GetDict.convert_rec(config.SpecialContinuations)
 
 class GetDict(dict):
     """
@@ -1,8 +1,12 @@
+import functools
 from datetime import timedelta, datetime
 
 from gtfs_loader.schema import CalendarDate, ExceptionType
 from gtfs_loader.types import GTFSDate
 
+# Days after the end of the feed that a fixed-width day set can hold, for trips departing after midnight
+SHIFT_MARGIN = 7
+
 
 class DaySet(int):
 
@@ -44,18 +48,101 @@ class DaySet(int):
             if self[i]:
                 yield i
 
+    def count(self):
+        return self.bit_count()
+
+
+class FixedDaySet(int):
+    """
+    The same API as DaySet, for days within a feed-wide width, used when config.Performance.day_set is 'fixed'. Each
+    ServiceDays uses the subclass of its width, from of_width, so that feeds (or windows) of different widths can be
+    processed side by side. Operations skip the Python constructor of DaySet, shifts never grow a set past the width,
+    and iteration jumps from one day of service to the next instead of testing every day.
+    """
+    __slots__ = ()
+    width = None
+    mask = None  # Set by of_width
+
+    @staticmethod
+    @functools.cache
+    def of_width(width):
+        return type(f'FixedDaySet{width}', (FixedDaySet,), {'__slots__': (), 'width': width, 'mask': (1 << width) - 1})
+
+    def __reduce__(self):
+        return fixed_day_set, (self.width, int(self))
+
+    def intersection(a, b):
+        return a.__class__(a & b)
+
+    def union(a, b):
+        return a.__class__(a | b)
+
+    def difference(a, b):
+        return a.__class__(a & ~b)
+
+    def isdisjoint(a, b):
+        return a & b == 0
+
+    def issuperset(a, b):
+        return a & b == b
+
+    def isequal(a, b):
+        return a == b
+
+    def shift(day_set, num_days):
+        cls = day_set.__class__
+        if num_days >= 0:
+            return cls((day_set << num_days) & cls.mask)
+
+        return cls(day_set >> -num_days)
+
+    def __getitem__(self, day):
+        return self >> day & 1 == 1
+
+    def __len__(self):
+        return self.bit_length()
+
+    def __iter__(self):
+        bits = format(self, 'b')[::-1]
+        day = bits.find('1')
+        while day >= 0:
+            yield day
+            day = bits.find('1', day + 1)
+
+    def count(self):
+        return self.bit_count()
+
+
+def fixed_day_set(width, days):
+    return FixedDaySet.of_width(width)(days)
+
 
 class ServiceDays:
 
-    def __init__(self, gtfs) -> None:
+    def __init__(self, gtfs, window=None, day_set='int') -> None:
+        """
+        With a window (start, end), only the days of service between these two dates are kept, counted from start.
+        day_set is the representation of days of service, as in config.Performance.day_set.
+        """
         print('Calculating days by service')
         self.gtfs = gtfs
         self.synth_service_counter = 0  # Number of services we needed to add to the feed
-        self.init_days_by_service(gtfs)
-        self.service_by_days = ServiceDays.get_reverse_index(
-            self.days_by_service)
-
-    def init_days_by_service(self, gtfs):
+        self.day_set_type = FixedDaySet if day_set == 'fixed' else DaySet
+        self.clipped_service_ids = set()  # Services with days outside the window
+        # Days of service in other frames of reference, memoized as the same few are requested over and over
+        self.days_by_service_shift = {}
+        self.shifted_days = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.init_days_by_service(gtfs, window)
+        # A clipped service would also add its days outside the window to any trip assigned to it
+        self.service_by_days = ServiceDays.get_reverse_index({
+            service_id: days
+            for service_id, days in self.days_by_service.items()
+            if service_id not in self.clipped_service_ids
+        })
+
+    def init_days_by_service(self, gtfs, window=None):
         all_service_ids = gtfs.calendar.keys() | gtfs.calendar_dates.keys()
         days_by_service = {}
         weekdays = [
@@ -77,38 +164,69 @@ class ServiceDays:
                 start_day = min(start_day, date.date)
                 end_day = max(end_day, date.date)
 
-        num_days = (end_day - start_day).days + 1
-
         for service_id in all_service_ids:
             service_days = 0
             calendar = gtfs.calendar.get(service_id)
 
             if calendar:
-                num_days = (calendar.end_date - calendar.start_date).days + 1
-                current_day = calendar.start_date
-                start_index = (current_day - start_day).days
-
-                for i in range(num_days):
-                    weekday_name = weekdays[current_day.weekday()]
+                service_days = calendar_days(calendar, weekdays) << (calendar.start_date - start_day).days
 
-                    if calendar[weekday_name]:
-                        date_index = 1 << (start_index + i)
-                        service_days |= date_index
+            # Only the last exception of each date counts, as if they were applied one after another
+            exception_types = {(date.date - start_day).days: date.exception_type
+                               for date in gtfs.calendar_dates.get(service_id, [])}
+            if exception_types:
+                added = day_bits(day for day, exception_type in exception_types.items()
+                                 if exception_type == ExceptionType.ADD)
+                removed = day_bits(day for day, exception_type in exception_types.items()
+                                   if exception_type != ExceptionType.ADD and day >= 0)
+                service_days = (service_days | added) & ~removed
 
-                    current_day += timedelta(days=1)
+            days_by_service[service_id] = service_days
 
-            for date in gtfs.calendar_dates.get(service_id, []):
-                date_index = 1 << (date.date - start_day).days
-                if date.exception_type == ExceptionType.ADD:
-                    service_days |= date_index
-                else:
-                    service_days &= ~(date_index)
+        if window:
+            start_day, days_by_service = self.clip(days_by_service, start_day, window)
+            end_day = window[1]
 
-            days_by_service[service_id] = DaySet(service_days)
+        num_days = (end_day - start_day).days + 1
+        self.width = max(num_days, 0) + SHIFT_MARGIN
+        if self.day_set_type is FixedDaySet:
+            self.day_set_type = FixedDaySet.of_width(self.width)
 
-        self.days_by_service = days_by_service
+        self.days_by_service = {
+            service_id: self.day_set_type(service_days)
+            for service_id, service_days in days_by_service.items()
+        }
         self.epoch = start_day
 
+    def clip(self, days_by_service, start_day, window):
+        """
+        Returns the start of the window, and the days of each service within the window, counted from its start.
+        """
+        window_start, window_end = window
+        offset = (window_start - start_day).days
+        window_mask = (1 << max((window_end - window_start).days + 1, 0)) - 1
+
+        clipped_days_by_service = {}
+        for service_id, service_days in days_by_service.items():
+            if offset >= 0:
+                clipped_days = (service_days >> offset) & window_mask
+                restored_days = clipped_days << offset
+            else:
+                clipped_days = (service_days << -offset) & window_mask
+                restored_days = clipped_days >> -offset
+
+            if restored_days != service_days:
+                self.clipped_service_ids.add(service_id)
+            clipped_days_by_service[service_id] = clipped_days
+
+        return window_start, clipped_days_by_service
+
+    def __getstate__(self):
+        # The feed is not needed to look up days of service (e.g. from worker processes)
+        state = self.__dict__.copy()
+        state['gtfs'] = None
+        return state
+
     @staticmethod
     def get_reverse_index(days_by_service):
         return {
@@ -116,8 +234,14 @@ class ServiceDays:
         }
 
     def days_by_trip(self, trip, extra_shift=0):
-        return self.days_by_service[trip.service_id].shift(trip.shift_days +
-                                                           extra_shift)
+        key = (trip.service_id, trip.shift_days + extra_shift)
+        days = self.days_by_service_shift.get(key)
+        if days is None:
+            self.cache_misses += 1
+            days = self.days_by_service_shift[key] = self.days_by_service[trip.service_id].shift(key[1])
+        else:
+            self.cache_hits += 1
+        return days
 
     @staticmethod
     def get_shift(from_trip, to_trip):
@@ -127,10 +251,24 @@ class ServiceDays:
         return -1 if to_trip.first_departure < from_trip.last_arrival else 0
 
     def days_in_from_frame(self, from_trip, to_trip, days):
-        return days.shift(ServiceDays.get_shift(from_trip, to_trip))
+        return self.shift(days, ServiceDays.get_shift(from_trip, to_trip))
 
     def days_in_to_frame(self, from_trip, to_trip, days):
-        return days.shift(-ServiceDays.get_shift(from_trip, to_trip))
+        return self.shift(days, -ServiceDays.get_shift(from_trip, to_trip))
+
+    def shift(self, days, num_days):
+        if num_days == 0:
+            # Day sets are immutable
+            return days
+
+        key = (days, num_days)
+        shifted_days = self.shifted_days.get(key)
+        if shifted_days is None:
+            self.cache_misses += 1
+            shifted_days = self.shifted_days[key] = days.shift(num_days)
+        else:
+            self.cache_hits += 1
+        return shifted_days
 
     def get_or_assign(self, trip, days):
         """
@@ -168,6 +306,76 @@ class ServiceDays:
         return pdates(list(self.to_dates(dates)))
 
 
+def parse_window(text):
+    """
+    Parses a window of service days given as START:END, two dates in the GTFS format (YYYYMMDD), both included.
+    """
+    start, _, end = text.partition(':')
+    window = datetime.strptime(start, '%Y%m%d'), datetime.strptime(end, '%Y%m%d')
+    if window[1] < window[0]:
+        raise ValueError(f'{text}: end of window precedes its start')
+    return window
+
+
+def calendar_days(calendar, weekdays):
+    """
+    Days of service of a calendar.txt entry, from its start date. The days of its first week are repeated over the
+    whole range at once: multiplying by 1 + 2^7 + 2^14 + ... places a copy of the week every 7 bits.
+    """
+    num_days = (calendar.end_date - calendar.start_date).days + 1
+    if num_days <= 0:
+        return 0
+
+    first_weekday = calendar.start_date.weekday()
+    week = 0
+    for i in range(7):
+        if calendar[weekdays[(first_weekday + i) % 7]]:
+            week |= 1 << i
+
+    num_weeks = (num_days + 6) // 7
+    every_week = ((1 << (7 * num_weeks)) - 1) // 0x7f
+    return (week * every_week) & ((1 << num_days) - 1)
+
+
+def day_bits(days):
+    """
+    The set of the given days (non-negative indices) as an int, setting bits in a byte array rather than shifting an
+    ever larger int for each day.
+    """
+    days = list(days)
+    if not days:
+        return 0
+
+    bits = bytearray(max(days) // 8 + 1)
+    for day in days:
+        bits[day >> 3] |= 1 << (day & 7)
+    return int.from_bytes(bits, 'little')
+
+
+class LazyDates:
+    """
+    Days of service to be described in a warning. They are only expanded to dates and formatted, using one of the
+    functions below, once the warning is. Only the first day of services is kept, so that warnings can be sent to
+    another process cheaply.
+    """
+    __slots__ = ('epoch', 'days', 'describe')
+
+    def __init__(self, services, days, describe=None):
+        # A plain datetime, as gtfs_loader's GTFSDate can't be unpickled
+        self.epoch = datetime(*services.epoch.timetuple()[:3])
+        self.days = DaySet(days)
+        self.describe = describe or pdates
+
+    def to_dates(self):
+        return (self.epoch + timedelta(days=offset) for offset in self.days)
+
+    def __str__(self):
+        return self.describe(list(self.to_dates()))
+
+    def dates(self):
+        return [date.strftime('%Y-%m-%d') for date in self.to_dates()]
+
+
 def pdates(dates):
     sdates = sorted(date.strftime('%m-%d') for date in dates)
     tdates = ', '.join(sdates[:14])
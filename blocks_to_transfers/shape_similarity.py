@@ -2,41 +2,300 @@
 Implements similarity metrics based on trip shapes, used by convert to predict whether or not a continuation represents
 and in-seat transfer.
 """
-from . import config
+import hashlib
+import multiprocessing
+import struct
+from array import array
+from functools import cached_property
+from gtfs_loader.lat_lon import LatLon
+from . import instrumentation
+from .projection import PlanarPoint
 from math import *
 
+try:
+    import numpy
+except ImportError:
+    numpy = None  # Only required by the numpy similarity engine
 
-def trip_shapes_similar(similarity_results, shape_a, shape_b):
+
+class StopShape(tuple):
+    """
+    The sequence of stop locations of a trip. A single representative is shared by all trips serving the same sequence,
+    so derived representations needed by the similarity metric are computed at most once per distinct shape.
+    """
+
+    @staticmethod
+    def of(shape):
+        return shape if isinstance(shape, StopShape) else StopShape(shape)
+
+    @staticmethod
+    def unpack(packed, planar=False):
+        if planar:
+            return StopShape(
+                PlanarPoint(packed[i], packed[i + 1])
+                for i in range(0, len(packed), 2))
+
+        return StopShape(
+            LatLon(packed[i], packed[i + 1], unit=radians)
+            for i in range(0, len(packed), 2))
+
+    @cached_property
+    def planar(self):
+        """
+        Whether the stops were projected onto a plane (see projection.py) rather than being latitudes/longitudes.
+        """
+        return isinstance(self[0], PlanarPoint)
+
+    @cached_property
+    def packed(self):
+        """
+        Compact representation of the stop coordinates (in radians, or metres if planar), for transfer to other
+        processes.
+        """
+        if self.planar:
+            return array('d', (coord for pt in self for coord in (pt.x, pt.y)))
+
+        return array('d', (coord for pt in self for coord in (pt.lat, pt.lon)))
+
+    @cached_property
+    def digest(self):
+        """
+        Hash of the stop coordinates, identifying the shape across runs.
+        """
+        return hashlib.blake2b(struct.pack(f'<{len(self.packed)}d',
+                                           *self.packed),
+                               digest_size=16).digest()
+
+    @cached_property
+    def coords(self):
+        """
+        Latitudes and longitudes of the stops (in radians), or planar coordinates, as numpy arrays.
+        """
+        packed = numpy.frombuffer(self.packed)
+        return packed[0::2], packed[1::2]
+
+    def simplified(self, tolerance):
+        """
+        The shape simplified using the Douglas-Peucker algorithm: stops are removed as long as they remain within
+        tolerance (m) of the simplified shape. Computed once per tolerance.
+        """
+        simplified_by_tolerance = self.__dict__.setdefault('_simplified', {})
+        shape = simplified_by_tolerance.get(tolerance)
+        if shape is None:
+            shape = simplified_by_tolerance[tolerance] = StopShape(
+                self[i] for i in douglas_peucker(self, tolerance))
+        return shape
+
+    @cached_property
+    def segment_index(self):
+        """
+        Spatial index over the segments of the shape, or None if the shape is too short to benefit from one.
+        """
+        if len(self) - 1 < SegmentIndex.MIN_SEGMENTS:
+            return None
+
+        if self.planar:
+            return PlanarSegmentIndex.build(self)
+
+        return SegmentIndex.build(self)
+
+
+def trip_shapes_similar(similarity_results,
+                        shape_a,
+                        shape_b,
+                        run_config,
+                        persistent_cache=None):
     if shape_a is shape_b:
         return True
 
+    instrumentation.counters['shape_comparisons'] += 1
     cache_key = tuple(sorted((id(shape_a), id(shape_b))))
     cache_value = similarity_results.get(cache_key)
 
     if cache_value is not None:
         return cache_value
+
+    if persistent_cache is not None:
+        cache_value = persistent_cache.get(shape_a, shape_b)
+        if cache_value is None:
+            instrumentation.counters['hausdorff_computations'] += 1
+            cache_value = compute_shapes_similar(shape_a, shape_b, run_config)
+            persistent_cache.put(shape_a, shape_b, cache_value)
     else:
-        return similarity_results.setdefault(
-            cache_key, compute_shapes_similar(shape_a, shape_b))
+        instrumentation.counters['hausdorff_computations'] += 1
+        cache_value = compute_shapes_similar(shape_a, shape_b, run_config)
 
+    return similarity_results.setdefault(cache_key, cache_value)
 
-def compute_shapes_similar(shape_a, shape_b):
-    return hausdorff_percentile(
+
+def compute_shapes_similar(shape_a, shape_b, run_config):
+    in_seat, performance = run_config.InSeatTransfers, run_config.Performance
+    if performance.similarity_simplification:
+        shape_a = StopShape.of(shape_a).simplified(run_config.similarity_tolerance)
+        shape_b = StopShape.of(shape_b).simplified(run_config.similarity_tolerance)
+
+    if (performance.similarity_engine == 'python' and
+            performance.similarity_early_exit):
+        return hausdorff_percentile_below(
+            shape_a,
+            shape_b,
+            threshold=in_seat.similarity_percentile,
+            limit=in_seat.similarity_distance,
+            use_index=performance.similarity_index,
+            hot_counters=performance.hot_counters)
+
+    if performance.similarity_engine == 'python':
+        return hausdorff_percentile(
+            shape_a,
+            shape_b,
+            threshold=in_seat.similarity_percentile,
+            use_index=performance.similarity_index) < in_seat.similarity_distance
+
+    return get_engine(performance.similarity_engine)(
         shape_a,
         shape_b,
-        threshold=config.InSeatTransfers.similarity_percentile
-    ) < config.InSeatTransfers.similarity_distance
+        threshold=in_seat.similarity_percentile
+    ) < in_seat.similarity_distance
+
+
+def compute_shapes_similar_parallel(shape_pairs, num_workers, run_config):
+    """
+    Equivalent to calling compute_shapes_similar on each pair of shapes, in a pool of worker processes. Each distinct
+    shape is sent once to each worker, and only the indices of the shapes are sent for each pair.
+    """
+    if not shape_pairs:
+        return []
+
+    index_by_shape = {}
+    for shape_pair in shape_pairs:
+        for shape in shape_pair:
+            index_by_shape.setdefault(id(shape), (len(index_by_shape), shape))
+
+    packed_shapes = [shape.packed for _, shape in index_by_shape.values()]
+    index_pairs = [(index_by_shape[id(shape_a)][0], index_by_shape[id(shape_b)][0])
+                   for shape_a, shape_b in shape_pairs]
+
+    with multiprocessing.Pool(num_workers,
+                              initializer=_init_worker,
+                              initargs=(run_config,
+                                        packed_shapes,
+                                        shape_pairs[0][0].planar)) as pool:
+        results = pool.map(_compute_shapes_similar_by_index,
+                           index_pairs,
+                           chunksize=max(1, len(index_pairs) // (4 * num_workers)))
+
+    if run_config.Performance.hot_counters:
+        for _, counters in results:
+            instrumentation.counters.update(counters)
+        results = [similar for similar, _ in results]
+
+    return results
+
+
+_worker_config = None
+_worker_shapes = None
+
+
+def _init_worker(run_config, packed_shapes, planar):
+    global _worker_config, _worker_shapes
+    _worker_config = run_config
+    _worker_shapes = [
+        StopShape.unpack(packed, planar) for packed in packed_shapes
+    ]
 
 
-def hausdorff_percentile(shape_a, shape_b, threshold):
+def _compute_shapes_similar_by_index(index_pair):
+    shape_a, shape_b = _worker_shapes[index_pair[0]], _worker_shapes[index_pair[1]]
+    if not _worker_config.Performance.hot_counters:
+        return compute_shapes_similar(shape_a, shape_b, _worker_config)
+
+    with instrumentation.capture() as counters:
+        similar = compute_shapes_similar(shape_a, shape_b, _worker_config)
+    return similar, counters
+
+
+def get_engine(engine):
+    if engine == 'python':
+        return hausdorff_percentile
+
+    if engine == 'numpy':
+        if numpy is None:
+            raise ImportError(
+                'similarity_engine "numpy" requires numpy to be installed')
+        return hausdorff_percentile_numpy
+
+    raise ValueError(f'Unknown similarity_engine "{engine}"')
+
+
+def hausdorff_percentile(shape_a, shape_b, threshold, use_index=True):
     distances = distance_point_to_nearest_segment(shape_points=shape_a,
-                                                  shape_segments=shape_b)
+                                                  shape_segments=shape_b,
+                                                  use_index=use_index)
     distances.extend(
         distance_point_to_nearest_segment(shape_points=shape_b,
-                                          shape_segments=shape_a))
+                                          shape_segments=shape_a,
+                                          use_index=use_index))
     return percentile(distances, threshold)
 
 
+def hausdorff_percentile_below(shape_a, shape_b, threshold, limit, use_index=True, hot_counters=False):
+    """
+    Decides whether hausdorff_percentile(shape_a, shape_b, threshold) < limit, without sorting the distances. Instead,
+    distances are counted as they are computed, stopping as soon as the remaining ones can no longer change the answer.
+    """
+    num_values = len(shape_a) + len(shape_b)
+    float_index = threshold * (num_values + 1)
+    index, interpolation_factor = int(float_index // 1), float_index % 1
+
+    # The percentile is below the limit for certain once num_below_true values are, and is certainly not below the
+    # limit if fewer than num_below_false values can be. In between, it is interpolated from the largest value below
+    # the limit and the smallest value above it, exactly as percentile() would.
+    if index == 0:
+        num_below_true = num_below_false = 1
+    elif index >= num_values:
+        num_below_true = num_below_false = num_values
+    else:
+        num_below_true, num_below_false = index + 1, index
+
+    num_below, num_remaining = 0, num_values
+    max_below, min_above = -inf, inf
+
+    for distance in _iter_distances(shape_a, shape_b, use_index):
+        num_remaining -= 1
+        if distance < limit:
+            num_below += 1
+            max_below = max(max_below, distance)
+            if num_below >= num_below_true:
+                _count_skipped_distances(hot_counters, num_values, num_remaining)
+                return True
+        else:
+            min_above = min(min_above, distance)
+            if num_below + num_remaining < num_below_false:
+                _count_skipped_distances(hot_counters, num_values, num_remaining)
+                return False
+
+    # Only reached when exactly index values are below the limit
+    _count_skipped_distances(hot_counters, num_values, num_remaining)
+    return max_below + interpolation_factor * (min_above - max_below) < limit
+
+
+def _count_skipped_distances(hot_counters, num_values, num_remaining):
+    if hot_counters:
+        instrumentation.counters['hausdorff_distances'] += num_values - num_remaining
+        instrumentation.counters['hausdorff_distances_skipped'] += num_remaining
+        instrumentation.counters['hausdorff_early_exits'] += num_remaining > 0
+
+
+def _iter_distances(shape_a, shape_b, use_index):
+    nearest_segment_b = nearest_segment_finder(shape_b, use_index)
+    for pt in shape_a:
+        yield nearest_segment_b(pt)
+
+    nearest_segment_a = nearest_segment_finder(shape_a, use_index)
+    for pt in shape_b:
+        yield nearest_segment_a(pt)
+
+
 def percentile(values, threshold):
     # Percentile interpolation is based on: https://www.itl.nist.gov/div898/handbook/prc/section2/prc262.htm
     values.sort()
@@ -53,12 +312,24 @@ def percentile(values, threshold):
                                                        values[index - 1])
 
 
-def distance_point_to_nearest_segment(shape_points, shape_segments):
+def distance_point_to_nearest_segment(shape_points, shape_segments, use_index=True):
     """
     For each point in the first shape, return the closest distance from that point to any point on the second shape.
     """
-    distances = []
-    for pt in shape_points:
+    nearest_segment = nearest_segment_finder(shape_segments, use_index)
+    return [nearest_segment(pt) for pt in shape_points]
+
+
+def nearest_segment_finder(shape_segments, use_index=True):
+    """
+    Returns a function giving the closest distance from a point to any point on the shape, using its segment index if
+    use_index.
+    """
+    if use_index and isinstance(
+            shape_segments, StopShape) and shape_segments.segment_index:
+        return shape_segments.segment_index.nearest
+
+    def nearest_segment(pt):
         d_nearest_segment = inf
         for i_seg in range(len(shape_segments) - 1):
             d_point_segment = pt.distance_to_segment(shape_segments[i_seg],
@@ -66,6 +337,277 @@ def distance_point_to_nearest_segment(shape_points, shape_segments):
             if d_point_segment < d_nearest_segment:
                 d_nearest_segment = d_point_segment
 
-        distances.append(d_nearest_segment)
+        return d_nearest_segment
+
+    return nearest_segment
+
+
+def douglas_peucker(shape, tolerance):
+    """
+    Returns the indices of the stops retained when simplifying the shape.
+    """
+    keep = [False] * len(shape)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(shape) - 1)]
+
+    while stack:
+        first, last = stack.pop()
+        d_farthest, i_farthest = 0, None
+        for i in range(first + 1, last):
+            d_point_segment = shape[i].distance_to_segment(shape[first], shape[last])
+            if d_point_segment > d_farthest:
+                d_farthest, i_farthest = d_point_segment, i
+
+        if d_farthest > tolerance:
+            keep[i_farthest] = True
+            stack.append((first, i_farthest))
+            stack.append((i_farthest, last))
+
+    return [i for i, kept in enumerate(keep) if kept]
+
+
+class SegmentIndex:
+    """
+    Bounding box tree over the segments of a shape. Consecutive stops are close to each other, so each node simply
+    covers a contiguous range of segments, halved at each level. Boxes are in latitude/longitude, and the distance
+    from a point to a box gives a lower bound on the distance to any segment within it, allowing nearest-segment
+    queries to skip most of the shape.
+    """
+    MIN_SEGMENTS = 16  # Shorter shapes are searched exhaustively
+    LEAF_SEGMENTS = 4
+
+    __slots__ = ('shape', 'lo', 'hi', 'min_y', 'max_y', 'min_x', 'max_x',
+                 'cos_min', 'children')
+
+    def __init__(self, shape, lo, hi, boxes, children):
+        self.shape = shape
+        self.lo, self.hi = lo, hi
+        self.min_y = min(box[0] for box in boxes)
+        self.max_y = max(box[1] for box in boxes)
+        self.min_x = min(box[2] for box in boxes)
+        self.max_x = max(box[3] for box in boxes)
+        # Only used for latitudes: cos is concave over [-pi/2, pi/2], so its minimum over the box is reached at one
+        # of its edges
+        self.cos_min = min(cos(self.min_y), cos(self.max_y))
+        self.children = children
+
+    @classmethod
+    def build(cls, shape):
+        boxes = []
+        for l1, l2 in zip(shape, shape[1:]):
+            box = cls.segment_box(l1, l2)
+            if box is None:
+                return None
+            boxes.append(box)
+
+        return cls._build_range(shape, boxes, 0, len(boxes))
+
+    @classmethod
+    def _build_range(cls, shape, boxes, lo, hi):
+        if hi - lo <= cls.LEAF_SEGMENTS:
+            return cls(shape, lo, hi, boxes[lo:hi], None)
+
+        mid = (lo + hi) // 2
+        children = (cls._build_range(shape, boxes, lo, mid),
+                    cls._build_range(shape, boxes, mid, hi))
+        child_boxes = [(child.min_y, child.max_y, child.min_x, child.max_x)
+                       for child in children]
+        return cls(shape, lo, hi, child_boxes, children)
+
+    @staticmethod
+    def segment_box(l1, l2):
+        if abs(l2.lon - l1.lon) > pi:
+            return None  # Crosses the antimeridian: boxes would not bound the segment
+
+        # Great circle arcs bulge poleward of their endpoints; widen boxes by a conservative margin
+        margin = l1.angular_distance_to(l2)**2 / max(
+            cos(max(abs(l1.lat), abs(l2.lat))), 1e-6)
+        return (min(l1.lat, l2.lat) - margin, max(l1.lat, l2.lat) + margin,
+                min(l1.lon, l2.lon), max(l1.lon, l2.lon))
+
+    @staticmethod
+    def query(pt):
+        return pt.lat, pt.lon, cos(pt.lat)
+
+    def lower_bound(self, query):
+        """
+        Lower bound of the haversine of the angle between the queried point and any point within the box.
+        """
+        lat, lon, cos_lat = query
+        d_lat = max(self.min_y - lat, lat - self.max_y, 0)
+        d_lon = max(self.min_x - lon, lon - self.max_x, 0)
+        return sin(d_lat / 2)**2 + cos_lat * self.cos_min * sin(d_lon / 2)**2
+
+    @staticmethod
+    def bound_of_distance(distance):
+        # Slightly loosened, so rounding in the bound can never exclude an equally near segment
+        return sin(min(distance / LatLon.EARTH_RADIUS_M, pi) / 2)**2 * (1 + 1e-9)
+
+    def nearest(self, pt):
+        """
+        Equivalent to the distance from pt to the nearest segment found by an exhaustive search.
+        """
+        shape = self.shape
+        query = self.query(pt)
+        d_nearest_segment = inf
+        bound_nearest_segment = inf
+        stack = [(0, self)]
+
+        while stack:
+            bound, node = stack.pop()
+            if bound >= bound_nearest_segment:
+                continue
+
+            if node.children is None:
+                for i_seg in range(node.lo, node.hi):
+                    d_point_segment = pt.distance_to_segment(
+                        shape[i_seg], shape[i_seg + 1])
+                    if d_point_segment < d_nearest_segment:
+                        d_nearest_segment = d_point_segment
+
+                bound_nearest_segment = self.bound_of_distance(d_nearest_segment)
+                continue
+
+            near, far = ((child.lower_bound(query), child)
+                         for child in node.children)
+            if near[0] > far[0]:
+                near, far = far, near
+
+            # Visit the nearer child first
+            stack.append(far)
+            stack.append(near)
+
+        return d_nearest_segment
+
+
+class PlanarSegmentIndex(SegmentIndex):
+    """
+    SegmentIndex over a shape of projected points. Boxes are in planar coordinates.
+    """
+    __slots__ = ()
+
+    @staticmethod
+    def segment_box(l1, l2):
+        return (min(l1.y, l2.y), max(l1.y, l2.y), min(l1.x, l2.x),
+                max(l1.x, l2.x))
+
+    @staticmethod
+    def query(pt):
+        return pt.x, pt.y
+
+    def lower_bound(self, query):
+        """
+        Lower bound of the squared distance between the queried point and any point within the box.
+        """
+        x, y = query
+        d_x = max(self.min_x - x, x - self.max_x, 0)
+        d_y = max(self.min_y - y, y - self.max_y, 0)
+        return d_x * d_x + d_y * d_y
+
+    @staticmethod
+    def bound_of_distance(distance):
+        return distance * distance * (1 + 1e-9)
+
+
+def hausdorff_percentile_numpy(shape_a, shape_b, threshold):
+    """
+    Same metric as hausdorff_percentile, but all point-to-segment distances between the two shapes are computed as a
+    single batch of array operations.
+    """
+    shape_a, shape_b = StopShape.of(shape_a), StopShape.of(shape_b)
+    if shape_a.planar:
+        nearest_segment = distance_point_to_nearest_segment_numpy_planar
+    else:
+        nearest_segment = distance_point_to_nearest_segment_numpy
+
+    distances = numpy.concatenate(
+        (nearest_segment(shape_a.coords, shape_b.coords),
+         nearest_segment(shape_b.coords, shape_a.coords)))
+    return percentile_numpy(distances, threshold)
+
+
+def percentile_numpy(values, threshold):
+    """
+    Same as percentile, but only partially orders the values to find the two values surrounding the percentile.
+    """
+    float_index = threshold * (len(values) + 1)
+    index, interpolation_factor = int(float_index // 1), float_index % 1
+
+    if index == 0:
+        return float(values.min())
+
+    if index >= len(values):
+        return float(values.max())
+
+    lower, upper = numpy.partition(values, (index - 1, index))[index - 1:index + 1]
+    return float(lower + interpolation_factor * (upper - lower))
+
+
+def distance_point_to_nearest_segment_numpy(point_coords, segment_coords):
+    """
+    Vectorized form of distance_point_to_nearest_segment, evaluating LatLon.distance_to_segment for every pair of
+    point (rows) and segment (columns) at once.
+    """
+    lat, lon = point_coords[0][:, None], point_coords[1][:, None]
+    seg_lat, seg_lon = segment_coords
+    if len(seg_lat) < 2:
+        return numpy.full(len(point_coords[0]), inf)
+
+    lat1, lon1, lat2, lon2 = seg_lat[:-1], seg_lon[:-1], seg_lat[1:], seg_lon[1:]
+
+    d_l1_x = _angular_distance(lat1, lon1, lat, lon)
+    t_l1_x = _bearing(lat1, lon1, lat, lon)
+    d_l1_l2 = _angular_distance(lat1, lon1, lat2, lon2)
+    t_l1_l2 = _bearing(lat1, lon1, lat2, lon2)
+    d_l2_x = _angular_distance(lat2, lon2, lat, lon)
+
+    d_cross = numpy.arcsin(numpy.sin(d_l1_x) * numpy.sin(t_l1_x - t_l1_l2))
+    d_along = numpy.arccos(
+        numpy.clip(numpy.cos(d_l1_x) / numpy.cos(d_cross), -1, 1))
+
+    # lx: point along the segment closest to the point
+    lx_lat = numpy.arcsin(
+        numpy.sin(lat1) * numpy.cos(d_along) +
+        numpy.cos(lat1) * numpy.sin(d_along) * numpy.cos(t_l1_l2))
+    lx_lon = lon1 + numpy.arctan2(
+        numpy.sin(t_l1_l2) * numpy.sin(d_along) * numpy.cos(lat1),
+        numpy.cos(d_along) - numpy.sin(lat1) * numpy.sin(lx_lat))
+    d_lx_x = _angular_distance(lx_lat, lx_lon, lat, lon)
+
+    along_segment = (d_along < d_l1_l2) & (d_lx_x < d_l1_x) & (d_lx_x < d_l2_x)
+    d_segment = numpy.where(along_segment, d_lx_x,
+                            numpy.minimum(d_l1_x, d_l2_x))
+    return LatLon.EARTH_RADIUS_M * d_segment.min(axis=1)
+
+
+def distance_point_to_nearest_segment_numpy_planar(point_coords,
+                                                   segment_coords):
+    """
+    Same as distance_point_to_nearest_segment_numpy, for projected points (see PlanarPoint.distance_to_segment).
+    """
+    x, y = point_coords[0][:, None], point_coords[1][:, None]
+    seg_x, seg_y = segment_coords
+    if len(seg_x) < 2:
+        return numpy.full(len(point_coords[0]), inf)
+
+    x1, y1 = seg_x[:-1], seg_y[:-1]
+    d_x, d_y = seg_x[1:] - x1, seg_y[1:] - y1
+    length_sq = d_x * d_x + d_y * d_y
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        along = ((x - x1) * d_x + (y - y1) * d_y) / length_sq
+    along = numpy.where(length_sq == 0, 0, numpy.clip(along, 0, 1))
+    return numpy.hypot(x1 + along * d_x - x, y1 + along * d_y - y).min(axis=1)
+
+
+def _angular_distance(lat1, lon1, lat2, lon2):
+    a = numpy.sin((lat2 - lat1) / 2)**2 + numpy.cos(lat1) * numpy.cos(
+        lat2) * numpy.sin((lon2 - lon1) / 2)**2
+    return 2 * numpy.arcsin(numpy.sqrt(a))
+
 
-    return distances
+def _bearing(lat1, lon1, lat2, lon2):
+    y = numpy.sin(lon2 - lon1) * numpy.cos(lat2)
+    x = numpy.cos(lat1) * numpy.sin(lat2) - numpy.sin(lat1) * numpy.cos(
+        lat2) * numpy.cos(lon2 - lon1)
+    return numpy.arctan2(y, x)
@@ -0,0 +1,89 @@
+"""
+Keeps shape similarity results between runs, so that a feed processed repeatedly only needs to compare the stop
+shapes that changed since the previous run.
+"""
+import sqlite3
+from . import runtime_config
+
+
+class SimilarityCache:
+    """
+    SQLite file mapping pairs of stop shapes (identified by a hash of their stop coordinates) to the result of
+    compute_shapes_similar. The file is emptied whenever the options affecting the result change. Entries which
+    weren't used in the most recent runs are evicted once the file holds more than max_entries.
+    """
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path, max_entries=None, run_config=None):
+        run_config = run_config or runtime_config.load()
+        self.max_entries = max_entries or run_config.Performance.similarity_cache_entries
+        self.hits = 0
+        self.misses = 0
+        self.used_keys = []
+        self.new_results = []
+
+        self.db = sqlite3.connect(path)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS similarity (
+                shapes BLOB PRIMARY KEY, similar INTEGER, last_used INTEGER);
+        ''')
+
+        params = SimilarityCache.params(run_config)
+        if self._get_meta('params') != params:
+            self.db.execute('DELETE FROM similarity')
+            self._set_meta('params', params)
+
+        self.generation = int(self._get_meta('generation') or 0) + 1
+        self._set_meta('generation', str(self.generation))
+
+    @staticmethod
+    def params(run_config):
+        """
+        Options which affect the result of compute_shapes_similar.
+        """
+        return repr((SimilarityCache.SCHEMA_VERSION, *run_config.similarity_params))
+
+    @staticmethod
+    def key(shape_a, shape_b):
+        return b''.join(sorted((shape_a.digest, shape_b.digest)))
+
+    def get(self, shape_a, shape_b):
+        key = SimilarityCache.key(shape_a, shape_b)
+        row = self.db.execute('SELECT similar FROM similarity WHERE shapes = ?',
+                              (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.used_keys.append((self.generation, key))
+        return bool(row[0])
+
+    def put(self, shape_a, shape_b, similar):
+        self.new_results.append((SimilarityCache.key(shape_a, shape_b),
+                                 int(similar), self.generation))
+
+    def close(self):
+        with self.db:
+            self.db.executemany(
+                'UPDATE similarity SET last_used = ? WHERE shapes = ?',
+                self.used_keys)
+            self.db.executemany(
+                'INSERT OR REPLACE INTO similarity VALUES (?, ?, ?)',
+                self.new_results)
+            self.db.execute(
+                '''DELETE FROM similarity WHERE shapes IN (
+                    SELECT shapes FROM similarity
+                    ORDER BY last_used DESC LIMIT -1 OFFSET ?)''',
+                (self.max_entries,))
+        self.db.close()
+
+    def _get_meta(self, key):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?',
+                              (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                        (key, value))
@@ -0,0 +1,97 @@
+"""
+Reports how often simplifying stop shapes (config.Performance.similarity_simplification) changes the result of the
+similarity metric, for the pairs of shapes that classification of a feed's transfers would compare.
+
+Usage: python -m blocks_to_transfers.similarity_report [--simplification 0.25] <feed> [<feed> ...]
+
+A feed can also be a test case of tests/ (e.g. tests/test_hausdorff_kcm_125): its input files are combined with the
+files of tests/base, as tests/test_runner.py does.
+"""
+import argparse
+import collections
+import pathlib
+import shutil
+import tempfile
+import gtfs_loader
+from . import classify_transfers, config, convert_blocks, projection, runtime_config, service_days, shape_similarity
+
+
+def compare_feed(feed_dir, simplification, itineraries=False, run_config=None):
+    run_config = run_config or runtime_config.load()
+    in_seat = run_config.InSeatTransfers
+    gtfs = load_feed(feed_dir, itineraries=itineraries)
+    services = service_days.ServiceDays(gtfs, day_set=run_config.Performance.day_set)
+    feed_projection = projection.for_feed(gtfs, run_config.Performance.planar_distances)
+    transfers = convert_blocks.convert(gtfs, services, itineraries=itineraries,
+                                       feed_projection=feed_projection, run_config=run_config)
+
+    shape_match = classify_transfers.ShapeMatchState(feed_projection=feed_projection, run_config=run_config)
+    shape_pairs = {}
+    for transfer in transfers:
+        trip = gtfs.trips[transfer.from_trip_id]
+        cont_trip = gtfs.trips[transfer.to_trip_id]
+        if classify_transfers.get_heuristic_transfer_type(
+                run_config, feed_projection, collections.Counter(), trip, cont_trip) is not None:
+            continue
+
+        shape_a = classify_transfers.get_shape_ptr(shape_match, trip)
+        shape_b = classify_transfers.get_shape_ptr(shape_match, cont_trip)
+        if shape_a is not shape_b:
+            shape_pairs[tuple(sorted((id(shape_a), id(shape_b))))] = (shape_a, shape_b)
+
+    stats = collections.Counter()
+    tolerance = simplification * in_seat.similarity_distance
+    for shape in shape_match.shape_ptr_by_shape.values():
+        stats['stops'] += len(shape)
+        stats['simplified_stops'] += len(shape.simplified(tolerance))
+
+    for shape_a, shape_b in shape_pairs.values():
+        stats['pairs'] += 1
+        exact = shape_similarity.hausdorff_percentile(
+            shape_a, shape_b, in_seat.similarity_percentile)
+        approx = shape_similarity.hausdorff_percentile(
+            shape_a.simplified(tolerance), shape_b.simplified(tolerance),
+            in_seat.similarity_percentile)
+
+        limit = in_seat.similarity_distance
+        if (exact < limit) != (approx < limit):
+            stats['different_results'] += 1
+
+    return stats
+
+
+def load_feed(feed_dir, itineraries=False):
+    """
+    Loads a feed, or the feed of a test case: a directory with an input directory, next to a base directory of
+    files common to all test cases.
+    """
+    input_dir = pathlib.Path(feed_dir) / 'input'
+    if not input_dir.is_dir():
+        return gtfs_loader.load(feed_dir, itineraries=itineraries)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        for source_dir in (input_dir.parent.parent / 'base', input_dir):
+            for path in source_dir.iterdir():
+                shutil.copy2(path, work_dir)
+        return gtfs_loader.load(work_dir, itineraries=itineraries)
+
+
+def main():
+    cmd = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    cmd.add_argument('feeds', nargs='+', help='Paths to directories containing GTFS feeds')
+    cmd.add_argument('--simplification',
+                     type=float,
+                     default=config.Performance.similarity_simplification or .25,
+                     help='Tolerance, as a fraction of similarity_distance')
+    cmd.add_argument('--itineraries', action='store_true')
+    args = cmd.parse_args()
+
+    for feed_dir in args.feeds:
+        stats = compare_feed(feed_dir, args.simplification, itineraries=args.itineraries)
+        print(f'{feed_dir}: {stats["pairs"]} pairs of shapes compared, '
+              f'{stats["different_results"]} with a different result; '
+              f'{stats["simplified_stops"]}/{stats["stops"]} stops kept')
+
+
+if __name__ == '__main__':
+    main()
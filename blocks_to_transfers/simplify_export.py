@@ -47,6 +47,7 @@ def export_visit(graph, itineraries=False):
     delete_fully_split_trips(graph.gtfs, trip_id_splits, itineraries=itineraries)
     split_noncontinuation_transfers(graph.gtfs, trip_id_splits, transfers)
     graph.gtfs.transfers = transfers
+    clip_trips_to_window(graph.gtfs, graph.services, itineraries=itineraries)
 
 
 def split_noncontinuation_transfers(gtfs, trip_id_splits, transfers):
@@ -97,6 +98,39 @@ def make_trip(graph, trip_id_splits, node, itineraries=False):
     return split_trip_id
 
 
+def clip_trips_to_window(gtfs, services, itineraries=False):
+    """
+    With a service window, trips whose service also runs outside the window (whether they were in a block or not) are
+    assigned a service running only on their days within it, like split trips, so that every trip of the feed is
+    clipped to the window. Trips which never run within the window are deleted, with their transfers.
+    """
+    deleted_trip_ids = set()
+    for trip in list(gtfs.trips.values()):
+        if trip.service_id not in services.clipped_service_ids:
+            continue
+
+        days = services.days_by_trip(trip)
+        if days:
+            trip.service_id = services.get_or_assign(trip, days)
+            continue
+
+        deleted_trip_ids.add(trip.trip_id)
+        del gtfs.trips[trip.trip_id]
+        if not itineraries:
+            gtfs.stop_times.pop(trip.trip_id, None)
+
+    if not deleted_trip_ids:
+        return
+
+    for from_trip_id in list(gtfs.transfers.keys()):
+        if from_trip_id in deleted_trip_ids:
+            del gtfs.transfers[from_trip_id]
+        else:
+            gtfs.transfers[from_trip_id] = [
+                transfer for transfer in gtfs.transfers[from_trip_id] if transfer.to_trip_id not in deleted_trip_ids
+            ]
+
+
 def delete_fully_split_trips(gtfs, trip_id_splits, itineraries=False):
     """
     If a particular trip has been split into variants, remove the now-redundant
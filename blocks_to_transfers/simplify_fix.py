@@ -4,11 +4,17 @@ between trips, verify conditions and transform the representation.
 """
 import collections
 import enum
-from . import service_days, simplify_graph
+import functools
+import itertools
+from . import instrumentation, service_days, simplify_graph
 from .logs import Warn
 
 
-def simplify(gtfs, services, generated_transfers):
+def simplify(gtfs, services, generated_transfers, hot_counters=False, jobs=0):
+    """
+    After transfers are imported, the graph is fixed one connected component at a time, in jobs worker processes if
+    jobs > 1.
+    """
     print('Merging with predefined transfers and validating against spec')
     graph = simplify_graph.Graph(gtfs, services)
     primary_nodes = {}
@@ -17,15 +23,60 @@ def simplify(gtfs, services, generated_transfers):
     delete_impossible_edges(graph, print_warnings=True)
 
     import_generated_transfers(graph, primary_nodes, generated_transfers)
-    split_ordered_alternatives(graph)
-    delete_impossible_edges(graph, print_warnings=False)
-
     del primary_nodes
-    validate(graph)
 
+    components = graph.components()
+    instrumentation.counters['graph_components'] += len(components)
+    component_ids = {node: i for i, component in enumerate(components) for node in component.nodes}
+    component_of_nodes = [component_ids[node] for node in graph.nodes]
+    del component_ids
+
+    fixed_components = simplify_graph.map_components(
+        'simplify_fix', components, functools.partial(fix_component, hot_counters=hot_counters), jobs)
+    graph = merge_components(graph, component_of_nodes, fixed_components)
+
+    instrumentation.counters['graph_nodes'] += len(graph.nodes)
     return graph
 
 
+def fix_component(graph, hot_counters=False):
+    queue_log = []
+    split_ordered_alternatives(graph, hot_counters, queue_log)
+    delete_impossible_edges(graph, print_warnings=False)
+    validate(graph)
+    return graph, queue_log
+
+
+def merge_components(graph, component_of_nodes, fixed_components):
+    """
+    Merges fixed components (with the queue log of split_ordered_alternatives) into a single graph. Its nodes are in
+    the same order as if the whole graph had been fixed at once, so that trips and services are exported in the same
+    order: the nodes of graph (whose components are component_of_nodes), then split nodes in the order a single queue
+    over all components would have created them.
+    """
+    merged = simplify_graph.Graph(graph.gtfs, graph.services)
+    fixed_nodes = [iter(fixed.nodes) for fixed, _ in fixed_components]
+    queue_logs = [iter(queue_log) for _, queue_log in fixed_components]
+
+    for i_component in component_of_nodes:
+        merged.add_node(next(fixed_nodes[i_component]))
+
+    # Only the nodes of a component are queued when one of its nodes is taken from the queue, so each component
+    # takes its nodes from the queue in the same order as in a single queue
+    queue = collections.deque(component_of_nodes)
+    while queue:
+        i_component = queue.popleft()
+        num_split, num_queued = next(queue_logs[i_component])
+        for _ in range(num_split):
+            merged.add_node(next(fixed_nodes[i_component]))
+        queue.extend(itertools.repeat(i_component, num_queued))
+
+    for fixed, _ in fixed_components:
+        merged.sources.update(fixed.sources)
+        merged.sinks.update(fixed.sinks)
+    return merged
+
+
 def import_generated_transfers(graph, primary_nodes, generated_transfers):
     for transfer in generated_transfers:
         from_node = graph.make_primary_node(primary_nodes,
@@ -42,7 +93,7 @@ def import_generated_transfers(graph, primary_nodes, generated_transfers):
         graph.add_edge(from_node, to_node, transfer)
 
 
-def split_ordered_alternatives(graph):
+def split_ordered_alternatives(graph, hot_counters=False, queue_log=None):
     """
     The spec requires all from_trip_ids of a certain to_trip_id, and all to_trip_ids of a certain from_trip_id,
     to form 'disjoint cases' (either matching another case exactly, or disjoint of all cases.)
@@ -56,18 +107,25 @@ def split_ordered_alternatives(graph):
     This step splits primary nodes into separate nodes for each cases. For convenience of traversal over newly created
     nodes, we use BFS but any traversal order is valid. This step repeats roughly the same calculation as convert_blocks,
     but nodes can be split several times in a row in this operation.
+
+    If queue_log is a list, the number of nodes split and the number of nodes queued are appended to it for each node
+    taken from the queue.
     """
     queue = collections.deque(graph.nodes)
     visited = set()
+    num_requeued = 0
     while queue:
         from_node = queue.popleft()
         if from_node in visited:
+            if queue_log is not None:
+                queue_log.append((0, 0))
             continue
 
         visited.add(from_node)
+        num_nodes, queue_length = len(graph.nodes), len(queue)
 
         days_running = from_node.days
-        days_matched = service_days.DaySet()
+        days_matched = graph.services.day_set_type()
 
         for to_node, transfer in from_node.out_edges.generated_by_rank():
             to_days_in_frame = graph.services.days_in_from_frame(
@@ -82,9 +140,18 @@ def split_ordered_alternatives(graph):
                 to_node_split = graph.split(from_node, to_node, days_when_best)
                 if to_node_split:
                     queue.append(to_node_split)
+                    num_requeued += 1
 
             days_matched = days_matched.union(days_when_best)
             queue.append(to_node)
+            num_requeued += 1
+
+        if queue_log is not None:
+            queue_log.append((len(graph.nodes) - num_nodes, len(queue) - queue_length))
+
+    if hot_counters:
+        instrumentation.counters['split_alternatives_visited'] += len(visited)
+        instrumentation.counters['split_alternatives_requeued'] += num_requeued
 
 
 def import_predefined_transfers(graph, primary_nodes):
@@ -94,8 +161,9 @@ def import_predefined_transfers(graph, primary_nodes):
 
         for transfer in transfers:
             if transfer.from_trip_id == transfer.to_trip_id:
-                Warn(f'Removed self-transfer for trip {transfer.from_trip_id}'
-                    ).print()
+                Warn('Removed self-transfer for trip {trip_ids[0]}',
+                     code='self_transfer',
+                     trip_ids=[transfer.from_trip_id]).print()
                 continue
 
             if not transfer.is_continuation:
@@ -126,7 +194,9 @@ def delete_impossible_edges(graph, print_warnings):
             if not match_days:
                 if print_warnings:
                     Warn(
-                        f'Removing {from_node.trip_id} -> {to_node.trip_id} as it does not occur on any days of service.'
+                        'Removing {trip_ids[0]} -> {trip_ids[1]} as it does not occur on any days of service.',
+                        code='transfer_never_occurs',
+                        trip_ids=[from_node.trip_id, to_node.trip_id]
                     ).print()
                 graph.del_edge(from_node, to_node)
 
@@ -150,7 +220,7 @@ def validate(graph):
 
 
 def validate_distinct_cases(graph, edge_type, node, neighbours):
-    union_cases = service_days.DaySet()
+    union_cases = graph.services.day_set_type()
     distinct_cases = set()
     is_composite = False
 
@@ -179,14 +249,9 @@ def validate_distinct_cases(graph, edge_type, node, neighbours):
             distinct_cases.add(match_days)
             continue
 
-        conflict_days = ', '.join(
-            str(date) for date in graph.services.to_dates(
-                match_days.intersection(union_cases)))
-        conflict_days = graph.services.bdates(
-            match_days.intersection(union_cases))
-        other_trips = ', '.join(other_node.trip_id
-                                for other_node in neighbours
-                                if other_node is not neighbour)
+        conflict_days = service_days.LazyDates(
+            graph.services, match_days.intersection(union_cases),
+            service_days.wdates)
 
         if edge_type is simplify_graph.EdgeType.OUT:
             description = f"out edge of {node.trip_id} -> {neighbour.trip_id}"
@@ -195,10 +260,17 @@ def validate_distinct_cases(graph, edge_type, node, neighbours):
             description = f"{neighbour.trip_id} -> in edge of {node.trip_id}"
             graph.del_edge(neighbour, node)
 
-        Warn(f'''
+        Warn('''
             Removing {description} as it does not represent a disjoint case.
-                Conflict with other trips ({other_trips}) on {conflict_days}
-        ''').print()
+                Conflict with other trips ({other_trips}) on {days}
+        ''',
+             code='non_disjoint_case',
+             trip_ids=[node.trip_id, neighbour.trip_id],
+             days=conflict_days,
+             description=description,
+             other_trips=', '.join(other_node.trip_id
+                                   for other_node in neighbours
+                                   if other_node is not neighbour)).print()
 
     residual_days = node.days.difference(union_cases)
     if residual_days:
@@ -1,5 +1,11 @@
+import collections
 import enum
-from . import service_days
+import itertools
+import math
+import multiprocessing
+import time
+from . import instrumentation, service_days
+from .logs import Warn
 
 
 class Graph:
@@ -63,8 +69,41 @@ class Graph:
                           target_node.out_edges.copy())
         self.add_node(node_split)
         self.del_edge(from_node, to_node)
+        instrumentation.counters['node_splits'] += 1
         return node_split
 
+    def components(self):
+        """
+        Partitions the graph into its connected components, roughly one per block or cluster of predefined
+        transfers. Each component is a Graph with its nodes in the same order as in this graph, and the source and
+        sink nodes connected to them.
+        """
+        component_by_node = {}
+        components = []
+        for node in self.nodes:
+            if node in component_by_node:
+                continue
+
+            component = Graph(self.gtfs, self.services)
+            components.append(component)
+            component_by_node[node] = component
+            stack = [node]
+            while stack:
+                for neighbour in itertools.chain(*stack.pop().edges()):
+                    # Source and sink nodes only connect a single trip to the rest of the world
+                    if neighbour.has_trip() and neighbour not in component_by_node:
+                        component_by_node[neighbour] = component
+                        stack.append(neighbour)
+
+        for node in self.nodes:
+            component_by_node[node].nodes.append(node)
+        for source in self.sources:
+            component_by_node[next(iter(source.out_edges))].sources.add(source)
+        for sink in self.sinks:
+            component_by_node[next(iter(sink.in_edges))].sinks.add(sink)
+
+        return components
+
 
 class BaseNode:
 
@@ -84,6 +123,9 @@ class BaseNode:
     def has_trip(self):
         return self.trip is not None
 
+    def edges(self):
+        return self.in_edges, self.out_edges
+
     @property
     def trip_id(self):
         return self.trip.trip_id if self.has_trip() else '<NIL>'
@@ -126,3 +168,176 @@ class EdgeDict(dict):
 
     def copy(self):
         return EdgeDict(super().copy())
+
+
+def map_components(stage, components, func, num_jobs):
+    """
+    Applies func to each component, returning (graph, result) for each in the same order. func is a module-level
+    function, taking a component and returning the graph it was transformed into and a picklable result. With
+    num_jobs > 1, components are processed in a pool of worker processes, each sent with only its own trips and
+    transfers, and warnings are printed in the same order as a serial run. The time taken by each component is
+    recorded by instrumentation.
+    """
+    if num_jobs <= 1 or len(components) <= 1:
+        results = []
+        for component in components:
+            start = time.perf_counter()
+            trip_id, num_nodes = component.nodes[0].trip_id, len(component.nodes)
+            results.append(func(component))
+            instrumentation.record_component(stage, trip_id, num_nodes, time.perf_counter() - start)
+        return results
+
+    graph = components[0]
+    # Trips and transfers of the components sent so far, to rebuild the graphs the workers return in the same order
+    sent_entities = collections.deque()
+
+    def make_tasks():
+        for component in components:
+            trips, transfers = {}, {}
+            packed = pack(component, trips, transfers)
+            sent_entities.append((list(trips), list(transfers)))
+            yield func, packed, [WorkerTrip(trip) for trip in trips], [WorkerTransfer(transfer) for transfer in transfers]
+
+    results = []
+    with multiprocessing.Pool(num_jobs, initializer=_init_worker, initargs=(graph.services,)) as pool:
+        for packed, result, warnings, counters, timing in pool.imap(
+                _map_component_worker,
+                make_tasks(),
+                chunksize=max(1, len(components) // (8 * num_jobs))):
+            Warn.replay(warnings)
+            instrumentation.counters.update(counters)
+            instrumentation.record_component(stage, *timing)
+            trips, transfers = sent_entities.popleft()
+            results.append((unpack(packed, trips, transfers, graph.gtfs, graph.services), result))
+
+    return results
+
+
+_worker_services = None
+
+
+def _init_worker(services):
+    global _worker_services
+    _worker_services = services
+
+
+def _map_component_worker(task):
+    func, packed, trips, transfers = task
+    component = unpack(packed, trips, transfers, None, _worker_services)
+    with Warn.capture() as warnings, instrumentation.capture() as counters:
+        start = time.perf_counter()
+        trip_id, num_nodes = component.nodes[0].trip_id, len(component.nodes)
+        graph, result = func(component)
+        timing = (trip_id, num_nodes, time.perf_counter() - start)
+    # Nodes are split and edges removed, but trips and transfers are only ever those of the component
+    return (pack(graph, {trip: i for i, trip in enumerate(trips)},
+                 {transfer: i for i, transfer in enumerate(transfers)}),
+            result, warnings, counters, timing)
+
+
+class WorkerTrip:
+    """
+    The fields of a trip which simplifying a component needs, sent to worker processes instead of the trip, which
+    refers to the whole feed.
+    """
+    __slots__ = ('trip_id', 'service_id', 'block_id', 'shift_days', 'first_departure', 'last_arrival')
+
+    def __init__(self, trip):
+        self.trip_id = trip.trip_id
+        self.service_id = trip.service_id
+        self.block_id = trip.block_id
+        self.first_departure = trip.first_departure
+        if self.first_departure == -math.inf:
+            # The trip has no stop times
+            self.shift_days = self.last_arrival = None
+        else:
+            self.shift_days = trip.shift_days
+            self.last_arrival = trip.last_arrival
+
+    def __getitem__(self, field):
+        # As for a trip, e.g. simplify_linear.break_cycles
+        return getattr(self, field)
+
+
+class WorkerTransfer:
+    """
+    The fields of a transfer which simplifying a component needs, sent to worker processes.
+    """
+    __slots__ = ('from_trip_id', 'to_trip_id', 'transfer_type', 'is_generated', '_rank')
+
+    def __init__(self, transfer):
+        self.from_trip_id = transfer.from_trip_id
+        self.to_trip_id = transfer.to_trip_id
+        self.transfer_type = transfer.transfer_type
+        self.is_generated = transfer.is_generated
+        self._rank = getattr(transfer, '_rank', None)
+
+
+def pack(graph, trips, transfers):
+    """
+    Encodes graph to be sent to another process, which rebuilds it with unpack. Trips and transfers are sent as their
+    index in lists both processes have: trips and transfers map each to its index, and those of graph which are
+    missing are appended. Source and sink nodes, and the order of edges, are kept.
+    """
+    index = {}
+    base_nodes = []
+
+    def get_index(node):
+        i = index.get(node)
+        if i is None:
+            i = index[node] = len(base_nodes)
+            base_nodes.append(node)
+        return i
+
+    for node in itertools.chain(graph.nodes, graph.sources, graph.sinks):
+        get_index(node)
+
+    records = []
+    # Nodes are indexed as they are found, so base_nodes grows until all connected nodes are recorded
+    for node in base_nodes:
+        if isinstance(node, Node):
+            source_sink = (get_index(node.source_node), get_index(node.sink_node))
+        else:
+            source_sink = None
+
+        records.append((
+            trips.setdefault(node.trip, len(trips)) if node.has_trip() else None,
+            node.days,
+            node.composite,
+            source_sink,
+            [(get_index(to_node), None if transfer is None else transfers.setdefault(transfer, len(transfers)))
+             for to_node, transfer in node.out_edges.items()],
+            [get_index(from_node) for from_node in node.in_edges],
+        ))
+
+    return (records, len(graph.nodes), [index[source] for source in graph.sources],
+            [index[sink] for sink in graph.sinks])
+
+
+def unpack(packed, trips, transfers, gtfs, services):
+    records, num_nodes, sources, sinks = packed
+    base_nodes = []
+    for i_trip, days, composite, source_sink, _, _ in records:
+        # Nodes are created without their own source and sink nodes, which are recorded like any other node
+        node_class = BaseNode if source_sink is None else Node
+        node = node_class.__new__(node_class)
+        BaseNode.__init__(node, trips[i_trip] if i_trip is not None else None, days, EdgeDict(), EdgeDict())
+        node.composite = composite
+        base_nodes.append(node)
+
+    for node, (_, _, _, source_sink, out_edges, _) in zip(base_nodes, records):
+        if source_sink is not None:
+            node.source_node, node.sink_node = (base_nodes[i] for i in source_sink)
+        for i_to, i_transfer in out_edges:
+            node.out_edges[base_nodes[i_to]] = None if i_transfer is None else transfers[i_transfer]
+
+    for node, (_, _, _, _, _, in_edges) in zip(base_nodes, records):
+        for i_from in in_edges:
+            from_node = base_nodes[i_from]
+            node.in_edges[from_node] = from_node.out_edges[node]
+
+    graph = Graph(gtfs, services)
+    graph.nodes = base_nodes[:num_nodes]
+    graph.sources = {base_nodes[i] for i in sources}
+    graph.sinks = {base_nodes[i] for i in sinks}
+    return graph
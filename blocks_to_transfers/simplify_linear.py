@@ -1,15 +1,33 @@
 import collections
 import enum
+import functools
 import logging
-from . import simplify_graph
+from . import instrumentation, service_days, simplify_graph
 from .service_days import ServiceDays
 from .logs import Warn
 
 
-def simplify(graph):
+def simplify(graph, hot_counters=False, jobs=0):
+    """
+    Each connected component of graph is transformed separately, in jobs worker processes if jobs > 1.
+    """
     print('Applying linear simplification')
+    transformed_graph = simplify_graph.Graph(graph.gtfs, graph.services)
+    for component, _ in simplify_graph.map_components(
+            'simplify_linear', graph.components(),
+            functools.partial(simplify_component, hot_counters=hot_counters), jobs):
+        transformed_graph.nodes.extend(component.nodes)
+        transformed_graph.sources.update(component.sources)
+        transformed_graph.sinks.update(component.sinks)
+
+    instrumentation.counters['linear_graph_nodes'] += len(
+        transformed_graph.nodes)
+    return transformed_graph
+
+
+def simplify_component(graph, hot_counters=False):
     break_cycles(graph)
-    return find_paths(graph)
+    return find_paths(graph, hot_counters), None
 
 
 def break_cycles(graph):
@@ -77,11 +95,20 @@ def break_cycles(graph):
                 match_days)
             graph.sources.add(to_node.source_node)
 
-            Warn(f'''
-                Cycle {to_node.trip_id} -> ... -> {from_node.trip_id} -> {to_node.trip_id} [{graph.services.pdates(match_days)}]
-                Resolved {from_node.trip_id} -> {from_node.sink_node.trip_id} [{graph.services.pdates(from_node.sink_node.days)}]
-                Resolved {to_node.source_node.trip_id} -> {to_node.trip_id} [{graph.services.pdates(to_node.source_node.days)}]
-            ''').print()
+            Warn('''
+                Cycle {to_node.trip_id} -> ... -> {from_node.trip_id} -> {to_node.trip_id} [{days}]
+                Resolved {from_node.trip_id} -> {from_node.sink_node.trip_id} [{sink_days}]
+                Resolved {to_node.source_node.trip_id} -> {to_node.trip_id} [{source_days}]
+            ''',
+                 code='cycle',
+                 trip_ids=[from_node.trip_id, to_node.trip_id],
+                 days=service_days.LazyDates(graph.services, match_days),
+                 from_node=from_node,
+                 to_node=to_node,
+                 sink_days=service_days.LazyDates(graph.services,
+                                                  from_node.sink_node.days),
+                 source_days=service_days.LazyDates(
+                     graph.services, to_node.source_node.days)).print()
 
 
 class Transition:
@@ -100,7 +127,7 @@ class Transition:
         return getattr(self.node, key)
 
 
-def find_paths(graph):
+def find_paths(graph, hot_counters=False):
     """
     Enumerates all paths in the continuation graph, keeping track of the 
     intersection of all service days (limiting constraint). A new node is
@@ -114,8 +141,10 @@ def find_paths(graph):
         if node.composite:
             stack.append(Transition(node))
 
+    num_transitions = num_paths = 0
     while stack:
         from_node = stack.pop()
+        num_transitions += 1
         for to_node in from_node.out_edges.keys():
             shift_days = ServiceDays.get_shift(from_node.trip, to_node.trip)
             to_days_in_from_ref = to_node.days.shift(shift_days)
@@ -130,6 +159,7 @@ def find_paths(graph):
                 add_path_to_graph(transformed_graph,
                                   last_transition=from_node,
                                   days=match_days)
+                num_paths += 1
                 continue
 
             # A new edge continuing the block
@@ -144,15 +174,21 @@ def find_paths(graph):
             if to_node.composite:
                 # Acts like it were a sink node and ends the block
                 Warn(
-                    f'Composite node {to_node.trip_id} will not be split along {from_node.trip_id} -> {to_node.trip_id}'
+                    'Composite node {trip_ids[1]} will not be split along {trip_ids[0]} -> {trip_ids[1]}',
+                    code='composite_node',
+                    trip_ids=[from_node.trip_id, to_node.trip_id]
                 ).print()
                 add_path_to_graph(transformed_graph,
                                   last_transition=to_transition,
                                   days=match_days)
+                num_paths += 1
                 continue
 
             stack.append(to_transition)
 
+    if hot_counters:
+        instrumentation.counters['find_paths_transitions'] += num_transitions
+        instrumentation.counters['find_paths_paths'] += num_paths
     return transformed_graph
 
 
@@ -0,0 +1,219 @@
+"""
+Processes a feed with several configurations, e.g. to tune the heuristics of config.py, loading the feed and computing
+days of service only once. Continuations are only predicted again for configurations with different
+TripToTripTransfers options, and shapes are only compared again for configurations with different similarity options.
+No feed is written: for each configuration, the continuations which would be exported are summarized instead.
+
+Usage: python -m blocks_to_transfers.sweep [--linear] [--itineraries] [--service-window START:END] [--output FILE]
+                                          feed configs
+
+configs is a JSON file containing a list of config overrides (as in the -c option), or an object mapping names to
+config overrides.
+"""
+import argparse
+import collections
+import json
+import sys
+import time
+import gtfs_loader
+from gtfs_loader.schema import Transfer
+from . import (classify_transfers, convert_blocks, instrumentation, projection, runtime_config, service_days,
+               simplify_fix, simplify_linear)
+from .logs import Warn
+
+
+@instrumentation.one_run_at_a_time
+def sweep(in_dir, config_overrides, use_simplify_linear=False, itineraries=False, service_window=None):
+    """
+    config_overrides is a list of config overrides, or a dict mapping names to config overrides. Every configuration
+    is loaded before the feed, so that invalid options are reported at once. Returns a summary of the continuations of
+    each configuration (see summarize), along with its name, its number of warnings by code, how many pairs of shapes
+    were compared for it, and the time taken.
+    """
+    if isinstance(config_overrides, list):
+        config_overrides = {str(i): config_override for i, config_override in enumerate(config_overrides)}
+    run_configs = {name: runtime_config.load(config_override) for name, config_override in config_overrides.items()}
+
+    state = SweepState(gtfs_loader.load(in_dir, itineraries=itineraries), service_window, itineraries)
+    summaries = []
+    for name, run_config in run_configs.items():
+        print(f'Configuration {name}')
+        start = time.perf_counter()
+        with Warn.capture() as warnings, instrumentation.capture() as counters:
+            services = state.services(run_config)
+            graph = state.simplify(run_config, use_simplify_linear)
+
+        summary = {'name': name}
+        summary.update(summarize(graph, services))
+        summary.update(
+            warnings=dict(collections.Counter(warning.code for warning in warnings)),
+            shape_comparisons=counters['hausdorff_computations'],
+            time_s=round(time.perf_counter() - start, 3))
+        summaries.append(summary)
+
+    return summaries
+
+
+class SweepState:
+    """
+    The feed, and the results of each stage which configurations can share.
+    """
+
+    def __init__(self, gtfs, service_window=None, itineraries=False):
+        self.gtfs = gtfs
+        self.service_window = service_window
+        self.itineraries = itineraries
+        self.services_by_day_set = {}
+        self.projection_by_planar = {}
+        # Continuations as (from_trip_id, to_trip_id, rank), and the warnings raised finding them
+        self.converted_by_options = {}
+        self.shape_match_by_params = {}
+
+    def services(self, run_config):
+        day_set = run_config.Performance.day_set
+        services = self.services_by_day_set.get(day_set)
+        if services is None:
+            services = self.services_by_day_set[day_set] = service_days.ServiceDays(
+                self.gtfs, window=self.service_window, day_set=day_set)
+        return services
+
+    def projection(self, run_config):
+        planar = run_config.Performance.planar_distances
+        feed_projection = self.projection_by_planar.get(planar)
+        if feed_projection is None:
+            feed_projection = self.projection_by_planar[planar] = projection.for_feed(self.gtfs, planar)
+        return feed_projection
+
+    def convert(self, run_config):
+        """
+        Returns new transfers for the continuations found with the options of run_config, replaying the warnings
+        raised finding them.
+        """
+        options = (run_config.TripToTripTransfers, run_config.Performance.day_set,
+                   run_config.Performance.planar_distances)
+        converted = self.converted_by_options.get(options)
+        if converted is None:
+            with Warn.capture() as warnings:
+                transfers = convert_blocks.convert(self.gtfs,
+                                                   self.services(run_config),
+                                                   itineraries=self.itineraries,
+                                                   feed_projection=self.projection(run_config),
+                                                   run_config=run_config)
+            converted = self.converted_by_options[options] = (
+                [(transfer.from_trip_id, transfer.to_trip_id, transfer._rank) for transfer in transfers], warnings)
+        else:
+            print('\tReusing continuations predicted for a previous configuration')
+
+        continuations, warnings = converted
+        Warn.replay(warnings)
+        # Classification sets transfer_type, so each configuration gets its own transfers
+        return [
+            Transfer(from_trip_id=from_trip_id, to_trip_id=to_trip_id, _rank=rank)
+            for from_trip_id, to_trip_id, rank in continuations
+        ]
+
+    def classify(self, run_config):
+        transfers = self.convert(run_config)
+        shape_match = self.shape_match_by_params.get(run_config.similarity_params)
+        if shape_match is None:
+            shape_match = self.shape_match_by_params[run_config.similarity_params] = (
+                classify_transfers.ShapeMatchState(feed_projection=self.projection(run_config),
+                                                   run_config=run_config))
+
+        classify_transfers.classify(self.gtfs, transfers, run_config=run_config, shape_match=shape_match)
+        return transfers
+
+    def simplify(self, run_config, use_simplify_linear=False):
+        transfers = self.classify(run_config)
+        hot_counters, simplify_jobs = run_config.Performance.hot_counters, run_config.Performance.simplify_jobs
+        graph = simplify_fix.simplify(self.gtfs, self.services(run_config), transfers, hot_counters=hot_counters,
+                                      jobs=simplify_jobs)
+        if use_simplify_linear:
+            graph = simplify_linear.simplify(graph, hot_counters=hot_counters, jobs=simplify_jobs)
+        return graph
+
+
+def summarize(graph, services):
+    """
+    Counts what simplify_export.export_visit would write, without modifying the feed: continuations by transfer_type,
+    trips split into copies running on fewer days, trips clipped to the service window (see
+    simplify_export.clip_trips_to_window), and services created for these copies and clipped trips.
+    """
+    transfers_by_type = collections.Counter()
+    split_trips = set()
+    unsplit_trip_ids = set()
+    synthetic_services = set()
+
+    for node in graph.nodes:
+        for to_node, transfer in node.out_edges.items():
+            if to_node.has_trip():
+                transfers_by_type[int(transfer.transfer_type)] += 1
+
+        if node.days != services.days_by_trip(node.trip):
+            # As in ServiceDays.get_or_assign
+            days = node.days.shift(-node.trip.shift_days)
+            split_trips.add((node.trip_id, days))
+            if days not in services.service_by_days:
+                synthetic_services.add(days)
+        else:
+            unsplit_trip_ids.add(node.trip_id)
+
+    # Trips kept by export whose service also runs outside the window, whether they were in a block or not
+    split_trip_ids = {trip_id for trip_id, _ in split_trips} - unsplit_trip_ids
+    clipped_trips = 0
+    for trip in graph.gtfs.trips.values():
+        if trip.service_id not in services.clipped_service_ids or trip.trip_id in split_trip_ids:
+            continue
+
+        days = services.days_by_trip(trip)
+        if days:
+            clipped_trips += 1
+            days = days.shift(-trip.shift_days)
+            if days not in services.service_by_days:
+                synthetic_services.add(days)
+
+    return {
+        'transfers': {str(transfer_type): count for transfer_type, count in sorted(transfers_by_type.items())},
+        'split_trips': len(split_trips),
+        'clipped_trips': clipped_trips,
+        'synthetic_services': len(synthetic_services),
+    }
+
+
+def main():
+    cmd = argparse.ArgumentParser(description='Processes a feed with several configurations, summarizing the output')
+    cmd.add_argument('feed', help='Path to a directory containing a GTFS feed')
+    cmd.add_argument('configs', help='JSON file of a list of config overrides, or of an object mapping names to them')
+    cmd.add_argument('-L', '--linear', action='store_true', help='Apply linear simplification')
+    cmd.add_argument('--itineraries', action='store_true')
+    cmd.add_argument('--service-window', type=service_days.parse_window, metavar='START:END')
+    cmd.add_argument('--output', metavar='PATH', help='Write the summaries to this JSON file')
+    args = cmd.parse_args()
+
+    with open(args.configs) as f:
+        config_overrides = json.load(f)
+
+    try:
+        summaries = sweep(args.feed,
+                          config_overrides,
+                          use_simplify_linear=args.linear,
+                          itineraries=args.itineraries,
+                          service_window=args.service_window)
+    except (gtfs_loader.ParseError, runtime_config.InvalidConfigError, classify_transfers.InvalidRuleError) as exc:
+        print(f'Error: {type(exc).__name__}: {exc}')
+        sys.exit(1)
+
+    for summary in summaries:
+        transfers = ', '.join(f'{count} of type {transfer_type}'
+                              for transfer_type, count in summary['transfers'].items())
+        print(f'{summary["name"]}: {transfers or "no transfers"}; {summary["split_trips"]} split trips, '
+              f'{summary["clipped_trips"]} clipped trips, {summary["synthetic_services"]} synthetic services, '
+              f'{sum(summary["warnings"].values())} warnings ({summary["time_s"]:.2f}s)')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summaries, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""
+Generates synthetic GTFS feeds with blocks, to measure performance at scale. The same parameters and seed always
+produce the same feed.
+
+Each route is a line of stops served in both directions, so that continuations onto the return trip are compared by
+the similarity metric. Blocks alternate directions on one route, with a layover between trips. Some blocks run past
+midnight, some run around the clock (forming a cycle from one day to the next), some have alternative trips of other
+services (forming competing continuations), and some continuations are also given in transfers.txt.
+
+Usage: python -m blocks_to_transfers.synthetic_feed [--preset NAME] [--seed N] out_dir
+"""
+import argparse
+import csv
+import os
+import random
+from collections import namedtuple
+
+FeedParams = namedtuple(
+    'FeedParams',
+    (
+        'num_blocks',
+        'trips_per_block',
+        'stops_per_trip',
+        'num_services',
+        'multi_day_blocks',  # Fraction of blocks running past midnight
+        'cycle_blocks',  # Fraction of blocks running around the clock
+        'mixed_service_blocks',  # Fraction of blocks with alternative trips of other services
+        'predefined_transfers',  # Fraction of continuations also given in transfers.txt
+    ),
+    defaults=(8, 0.1, 0.02, 0.2, 0.05))
+
+PRESETS = {
+    'small': FeedParams(num_blocks=50, trips_per_block=10, stops_per_trip=10),
+    'medium': FeedParams(num_blocks=500, trips_per_block=20, stops_per_trip=20),
+    'huge': FeedParams(num_blocks=5000, trips_per_block=30, stops_per_trip=30, num_services=16),
+}
+
+START_DATE = '20240101'
+END_DATE = '20241231'
+CENTRE = (47.6, -122.3)
+STOP_SPACING = 0.004  # degrees, about 400 m
+BLOCKS_PER_ROUTE = 5
+
+# Days of the week of the first services, then random combinations
+DAILY_SERVICE = 3
+SERVICE_DAYS = [
+    (1, 1, 1, 1, 1, 0, 0),
+    (0, 0, 0, 0, 0, 1, 0),
+    (0, 0, 0, 0, 0, 0, 1),
+    (1, 1, 1, 1, 1, 1, 1),
+    (1, 0, 1, 0, 0, 0, 0),
+    (0, 1, 0, 1, 0, 0, 0),
+    (0, 0, 0, 0, 1, 1, 0),
+    (1, 1, 1, 1, 0, 0, 0),
+]
+
+
+def generate(out_dir, params, seed=0):
+    rng = random.Random(seed)
+    num_routes = max(1, params.num_blocks // BLOCKS_PER_ROUTE)
+    services = make_services(rng, params.num_services)
+    routes = [make_route(rng, i_route, params.stops_per_trip) for i_route in range(num_routes)]
+
+    trips = []
+    stop_times = []
+    transfers = []
+    for i_block in range(params.num_blocks):
+        route_id, stop_ids = routes[i_block % num_routes]
+        make_block(rng, params, f'b{i_block}', route_id, stop_ids, services, trips, stop_times, transfers)
+
+    os.makedirs(out_dir, exist_ok=True)
+    write_table(out_dir, 'agency.txt', ('agency_id', 'agency_name', 'agency_url', 'agency_timezone'),
+                [('SY', 'Synthetic Transit', 'https://transit.app', 'America/Los_Angeles')])
+    write_table(out_dir, 'calendar.txt',
+                ('service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday',
+                 'start_date', 'end_date'),
+                [(service_id, *days, START_DATE, END_DATE) for service_id, days in services])
+    write_table(out_dir, 'routes.txt', ('route_id', 'route_short_name', 'agency_id', 'route_type'),
+                [(route_id, route_id, 'SY', 3) for route_id, _ in routes])
+    write_table(out_dir, 'stops.txt', ('stop_id', 'stop_name', 'stop_lat', 'stop_lon'),
+                [stop for _, stop_ids in routes for stop in stop_ids])
+    write_table(out_dir, 'trips.txt', ('route_id', 'trip_id', 'service_id', 'block_id'), trips)
+    write_table(out_dir, 'stop_times.txt',
+                ('trip_id', 'stop_sequence', 'stop_id', 'arrival_time', 'departure_time'), stop_times)
+    write_table(out_dir, 'transfers.txt', ('from_trip_id', 'to_trip_id', 'transfer_type'), transfers)
+
+
+def make_services(rng, num_services):
+    services = []
+    for i_service in range(num_services):
+        if i_service < len(SERVICE_DAYS):
+            days = SERVICE_DAYS[i_service]
+        else:
+            days = tuple(rng.randint(0, 1) for _ in range(6)) + (1,)
+        services.append((f's{i_service}', days))
+    return services
+
+
+def make_route(rng, i_route, num_stops):
+    """
+    A line of stops in a random direction, drifting slightly at each stop.
+    """
+    lat = CENTRE[0] + rng.uniform(-0.2, 0.2)
+    lon = CENTRE[1] + rng.uniform(-0.3, 0.3)
+    d_lat, d_lon = rng.uniform(-1, 1), rng.uniform(-1, 1)
+    stops = []
+    for i_stop in range(num_stops):
+        stop_id = f'r{i_route}s{i_stop}'
+        stops.append((stop_id, f'Route {i_route} stop {i_stop}', f'{lat:.6f}', f'{lon:.6f}'))
+        d_lat += rng.uniform(-0.3, 0.3)
+        d_lon += rng.uniform(-0.3, 0.3)
+        norm = max(1e-6, (d_lat**2 + d_lon**2)**0.5)
+        lat += STOP_SPACING * d_lat / norm
+        lon += STOP_SPACING * d_lon / norm
+    return f'r{i_route}', stops
+
+
+def make_block(rng, params, block_id, route_id, stops, services, trips, stop_times, transfers):
+    kind = rng.random()
+    if kind < params.cycle_blocks:
+        # Trips back to back over exactly one day, so the last trip continues onto the first trip of the next day
+        start_time = 4 * 3600
+        trip_period = 86400 // params.trips_per_block
+        layover = min(300, trip_period // 4)
+        hop_time = (trip_period - layover) // (len(stops) - 1)
+    else:
+        if kind < params.cycle_blocks + params.multi_day_blocks:
+            start_time = rng.randint(18 * 3600, 22 * 3600)
+        else:
+            start_time = rng.randint(5 * 3600, 9 * 3600)
+        hop_time = rng.randint(60, 120)
+        trip_period = None
+
+    block_services = [service_id for service_id, _ in rng.sample(services, min(len(services), 3))]
+    main_service_id = block_services[0]
+    mixed_services = rng.random() < params.mixed_service_blocks
+    if mixed_services:
+        # Running every day, so that loop trips run on a subset of its days
+        main_service_id = services[DAILY_SERVICE][0] if len(services) > DAILY_SERVICE else main_service_id
+    max_end_time = 35 * 3600  # Times up to 36:00:00 are accepted
+
+    time = start_time
+    prev_trip_id = None
+    for i_trip in range(params.trips_per_block):
+        duration = hop_time * (len(stops) - 1)
+        if time + duration > max_end_time:
+            break
+
+        trip_id = f'{block_id}t{i_trip}'
+        trip_stops = stops if i_trip % 2 == 0 else stops[::-1]
+        add_trip(route_id, trip_id, main_service_id, block_id, trip_stops, time, hop_time, trips, stop_times)
+
+        if prev_trip_id and rng.random() < params.predefined_transfers:
+            transfers.append((prev_trip_id, trip_id, 4))
+
+        prev_trip_id = trip_id
+        if trip_period:
+            time = start_time + (i_trip + 1) * trip_period
+        elif mixed_services:
+            # Like test_competing_continuations_on_same_day: on some days, a short loop trip runs during the layover,
+            # so the next trip continues from either trip depending on the day
+            if rng.random() < 0.5:
+                add_trip(route_id, f'{trip_id}loop', rng.choice(block_services[1:] or block_services), block_id,
+                         [trip_stops[-1], trip_stops[-2], trip_stops[-1]], time + duration + 60, 120, trips,
+                         stop_times)
+            time += duration + rng.randint(600, 1080)
+        else:
+            time += duration + rng.randint(120, 600)
+
+
+def add_trip(route_id, trip_id, service_id, block_id, trip_stops, time, hop_time, trips, stop_times):
+    trips.append((route_id, trip_id, service_id, block_id))
+    for i_stop, stop in enumerate(trip_stops):
+        stop_time = gtfs_time(time + i_stop * hop_time)
+        stop_times.append((trip_id, i_stop, stop[0], stop_time, stop_time))
+
+
+def gtfs_time(seconds):
+    return f'{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+
+def write_table(out_dir, file_name, header, rows):
+    with open(os.path.join(out_dir, file_name), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def main():
+    cmd = argparse.ArgumentParser(description='Generates a synthetic GTFS feed with blocks')
+    cmd.add_argument('out_dir', help='Directory to contain the feed')
+    cmd.add_argument('--preset', choices=PRESETS, default='small', help='Size of the feed')
+    cmd.add_argument('--seed', type=int, default=0)
+    args = cmd.parse_args()
+    generate(args.out_dir, PRESETS[args.preset], args.seed)
+
+
+if __name__ == '__main__':
+    main()
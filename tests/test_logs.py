@@ -0,0 +1,105 @@
+import json
+import pickle
+import types
+import pytest
+from gtfs_loader.types import GTFSDate
+from blocks_to_transfers import logs, service_days
+from blocks_to_transfers.logs import Warn
+
+
+class CountingDescription:
+
+    def __init__(self):
+        self.num_formatted = 0
+
+    def __str__(self):
+        self.num_formatted += 1
+        return '01-02, 01-03'
+
+    def dates(self):
+        return ['2024-01-02', '2024-01-03']
+
+
+@pytest.fixture
+def sink(monkeypatch):
+
+    def use_sink(sink):
+        monkeypatch.setattr(Warn, 'sink', sink)
+        return sink
+
+    return use_sink
+
+
+def make_warning(code='overlap', days=None):
+    return Warn('''
+        Block {block_id} is invalid:
+            Occurs on days {days}.
+    ''',
+                code=code,
+                block_id='b1',
+                trip_ids=['t1', 't2'],
+                days=days or CountingDescription())
+
+
+def test_arguments_formatted_once_printed(capsys):
+    days = CountingDescription()
+    warning = make_warning(days=days)
+    assert days.num_formatted == 0
+
+    warning.print()
+    warning.print()
+    assert days.num_formatted == 1
+    assert capsys.readouterr().err == (
+        'Warning: Block b1 is invalid:\n'
+        '    Occurs on days 01-02, 01-03.\n\n') * 2
+
+
+def test_rate_limited_warnings_summarized(sink, capsys):
+    sink(logs.PrintSink(max_per_code=1))
+    suppressed_days = CountingDescription()
+    make_warning().print()
+    make_warning(days=suppressed_days).print()
+    make_warning(code='cycle').print()
+    Warn.sink.close()
+
+    assert suppressed_days.num_formatted == 0
+    assert capsys.readouterr().err.endswith('Warnings by code:\n'
+                                            '    cycle: 1\n'
+                                            '    overlap: 2 (1 not shown)\n')
+
+
+def test_buffered_sink_writes_json_lines(sink, tmp_path):
+    path = str(tmp_path / 'warnings.jsonl')
+    sink(logs.BufferedSink(path))
+    make_warning().print()
+    with Warn.capture() as records:
+        make_warning(code='cycle').print()
+    Warn.replay(records)
+    Warn.sink.close()
+
+    with open(path) as f:
+        lines = [json.loads(line) for line in f]
+    assert [line['code'] for line in lines] == ['overlap', 'cycle']
+    assert lines[0] == {
+        'code': 'overlap',
+        'block_id': 'b1',
+        'trip_ids': ['t1', 't2'],
+        'dates': ['2024-01-02', '2024-01-03'],
+        'message': str(make_warning())
+    }
+
+
+def test_captured_warnings_formatted_after_rate_limit(sink, capsys):
+    sink(logs.PrintSink(max_per_code=1))
+    services = types.SimpleNamespace(epoch=GTFSDate('20240101'))
+    with Warn.capture() as records:
+        for _ in range(2):
+            make_warning(days=service_days.LazyDates(services, 0b110)).print()
+
+    # As if sent from a worker process
+    records = pickle.loads(pickle.dumps(records))
+    assert all(record._message is None for record in records)
+    Warn.replay(records)
+
+    assert records[1]._message is None
+    assert capsys.readouterr().err == str(make_warning()) + '\n'
@@ -1,10 +1,25 @@
+import collections
+import csv
+import pstats
 import pytest
 from gtfs_loader import test_support
 import blocks_to_transfers.processing
+from blocks_to_transfers import config, instrumentation
 
 
 test_support.init(__file__)
 
+# Options which must not change the output
+PERFORMANCE_OPTIONS = {
+    'numpy_similarity': {'similarity_engine': 'numpy'},
+    'similarity_workers': {'similarity_workers': 2},
+    'jobs': {'jobs': 2},
+    'hot_counters': {'hot_counters': True, 'jobs': 2, 'similarity_workers': 2},
+    'fixed_day_set': {'day_set': 'fixed', 'jobs': 2},
+    'per_transfer_classification': {'batch_classification': False, 'similarity_workers': 2},
+    'simplify_jobs': {'simplify_jobs': 2},
+}
+
 
 @pytest.mark.parametrize('feed_dir',
                          test_support.find_tests('standard'),
@@ -20,13 +35,107 @@ def test_linear(feed_dir):
     do_test(feed_dir, 'linear')
 
 
+@pytest.mark.parametrize('options',
+                         PERFORMANCE_OPTIONS.values(),
+                         ids=PERFORMANCE_OPTIONS.keys())
+@pytest.mark.parametrize('feed_dir',
+                         test_support.find_tests('standard'),
+                         ids=lambda test_dir: test_dir.name)
+def test_performance_options(feed_dir, options, monkeypatch):
+    if options.get('similarity_engine') == 'numpy':
+        pytest.importorskip('numpy')
+
+    for k, v in options.items():
+        monkeypatch.setattr(config.Performance, k, v)
+
+    do_test(feed_dir, 'standard')
+
+
+@pytest.mark.parametrize('feed_dir',
+                         test_support.find_tests('linear'),
+                         ids=lambda test_dir: test_dir.name)
+def test_linear_simplify_jobs(feed_dir, monkeypatch):
+    monkeypatch.setattr(config.Performance, 'simplify_jobs', 2)
+    do_test(feed_dir, 'linear')
+
+
+@pytest.mark.parametrize('feed_dir',
+                         test_support.find_tests('linear')[:1],
+                         ids=lambda test_dir: test_dir.name)
+def test_profile_report(feed_dir, monkeypatch, tmp_path):
+    monkeypatch.setattr(config.Performance, 'hot_counters', True)
+    with instrumentation.profile(str(tmp_path / 'run.pstats')):
+        report = do_test(feed_dir, 'linear').to_dict()
+
+    assert [stage['name'] for stage in report['stages']] == [
+        'load', 'service_days', 'convert', 'classify', 'simplify_fix',
+        'simplify_linear', 'export_visit', 'set_pickup_drop_off', 'patch'
+    ]
+    assert all(stage['wall_time_s'] >= 0 for stage in report['stages'])
+    counters = report['counters']
+    assert counters['blocks'] > 0
+    assert counters['candidate_pairs'] >= counters['transfers_generated'] > 0
+    assert counters['graph_nodes'] >= counters['graph_components'] > 0
+    assert counters['find_paths_transitions'] >= counters['find_paths_paths'] > 0
+    assert counters['service_days_cache_hits'] > counters['service_days_cache_misses'] > 0
+    assert {component['stage'] for component in report['slowest_components']} == {'simplify_fix', 'simplify_linear'}
+    assert all(component['nodes'] > 0 for component in report['slowest_components'])
+    assert pstats.Stats(str(tmp_path / 'run.pstats')).total_calls > 0
+    assert (tmp_path / 'run.txt').read_text().startswith('Counters:\n')
+
+
+def test_service_window(tmp_path):
+    feed_dir = test_support.TEST_DIR / 'test_competing_continuations_on_same_day'
+    work_dir = test_support.create_test_data(feed_dir)
+    # A trip outside of any block, and one whose service never runs within the window
+    with open(work_dir / 'trips.txt', 'a') as f:
+        f.write('99,unblocked,mon,\n99,outside,weekday,\n')
+    with open(work_dir / 'stop_times.txt') as f:
+        trip_1_stop_times = [line for line in f if line.startswith('trip_1,')]
+    with open(work_dir / 'stop_times.txt', 'a') as f:
+        for trip_id in ('unblocked', 'outside'):
+            f.writelines(line.replace('trip_1,', f'{trip_id},', 1) for line in trip_1_stop_times)
+
+    blocks_to_transfers.process_with_config(work_dir, tmp_path, {}, service_window='20210301:20210314')
+
+    with open(tmp_path / 'trips.txt') as f:
+        service_ids = {trip['trip_id']: trip['service_id'] for trip in csv.DictReader(f)}
+    with open(tmp_path / 'calendar_dates.txt') as f:
+        dates_by_service = collections.defaultdict(set)
+        for date in csv.DictReader(f):
+            dates_by_service[date['service_id']].add(date['date'])
+
+    # Every trip only runs within the window, whether it was split or not
+    assert 'outside' not in service_ids
+    assert all(service_id.startswith('b2t:service_') for service_id in service_ids.values())
+    assert set(dates_by_service) == set(service_ids.values())
+    assert all('20210301' <= date <= '20210314' for dates in dates_by_service.values() for date in dates)
+    assert dates_by_service[service_ids['unblocked']] == {'20210301', '20210308'}
+    assert len(dates_by_service[service_ids['trip_1']]) == 12
+    split_service_ids = {service_id for trip_id, service_id in service_ids.items() if trip_id.startswith('trip_3_')}
+    assert len(split_service_ids) == 2
+    assert sum(len(dates_by_service[service_id]) for service_id in split_service_ids) == 12
+
+
+def test_overlapping_runs_refused(tmp_path):
+    feed_dir = test_support.TEST_DIR / 'test_competing_continuations_on_same_day'
+    work_dir = test_support.create_test_data(feed_dir)
+    # As if another thread was processing a feed
+    with instrumentation.run_lock:
+        with pytest.raises(RuntimeError, match='another feed is processed'):
+            blocks_to_transfers.process_with_config(work_dir, tmp_path, {})
+
+    blocks_to_transfers.process_with_config(work_dir, tmp_path, {})
+
+
 def do_test(feed_dir, simplification):
     work_dir = test_support.create_test_data(feed_dir)
 
-    blocks_to_transfers.processing.process(
+    report = blocks_to_transfers.processing.process(
         work_dir, work_dir, 
         use_simplify_linear=(simplification == 'linear'),
         sorted_io=True,
         itineraries=('itins' in feed_dir.name))
 
     test_support.check_expected_output(feed_dir, work_dir, tag=simplification)
+    return report
@@ -0,0 +1,73 @@
+import pickle
+import pytest
+from blocks_to_transfers import config, runtime_config
+
+
+def test_override_leaves_config_unchanged():
+    run_config = runtime_config.load({'InSeatTransfers': {'max_wait_time': 900, 'banned_stops': ['Depot']}})
+
+    assert run_config.InSeatTransfers.max_wait_time == 900
+    assert run_config.TripToTripTransfers.max_wait_time == config.TripToTripTransfers.max_wait_time
+    assert config.InSeatTransfers.max_wait_time == 600
+    assert config.InSeatTransfers.banned_stops == []
+    assert runtime_config.load().InSeatTransfers.max_wait_time == 600
+    # Rules added for banned stops only belong to the configuration which bans them
+    assert len(run_config.SpecialContinuations) == len(config.SpecialContinuations) + 1
+    assert run_config.rule_index.rules is run_config.SpecialContinuations
+
+
+def test_read_only():
+    run_config = runtime_config.load()
+    with pytest.raises(AttributeError):
+        run_config.InSeatTransfers.max_wait_time = 900
+    with pytest.raises(AttributeError):
+        run_config.Performance = None
+
+
+def test_sections_compared_by_options():
+    run_config = runtime_config.load()
+    other_config = runtime_config.load({'InSeatTransfers': {'same_location_distance': 200}})
+
+    assert run_config.TripToTripTransfers == other_config.TripToTripTransfers
+    assert hash(run_config.TripToTripTransfers) == hash(other_config.TripToTripTransfers)
+    assert run_config.InSeatTransfers != other_config.InSeatTransfers
+    assert run_config.similarity_params == other_config.similarity_params
+
+
+def test_derived_values():
+    run_config = runtime_config.load({
+        'InSeatTransfers': {'similarity_distance': 200},
+        'Performance': {'similarity_simplification': .25}
+    })
+    assert run_config.similarity_tolerance == 50
+    assert run_config.similarity_params == (.8, 200, .25, False)
+
+
+def test_pickled_for_worker_processes():
+    run_config = runtime_config.load({'Performance': {'jobs': 4}, 'InSeatTransfers': {'banned_stops': ['Depot']}})
+    copy = pickle.loads(pickle.dumps(run_config))
+
+    assert copy.Performance == run_config.Performance
+    assert copy.SpecialContinuations == run_config.SpecialContinuations
+    with pytest.raises(AttributeError):
+        copy.Performance.jobs = 1
+
+
+@pytest.mark.parametrize('config_override, message', [
+    ({'InSeat': {}}, 'Unknown section InSeat'),
+    ({'InSeatTransfers': {'max_wait': 600}}, 'Unknown option InSeatTransfers.max_wait'),
+    ({'InSeatTransfers': {'max_wait_time': '600'}}, 'must be of type int'),
+    ({'InSeatTransfers': {'same_route_104': 1}}, 'must be of type bool'),
+    ({'TripToTripTransfers': {'max_deadheading_speed': True}}, 'must be of type int'),
+    ({'Performance': {'day_set': 'bytes'}}, 'must be one of int, fixed'),
+    ({'SpecialContinuations': {}}, 'must be a list'),
+])
+def test_invalid_options(config_override, message):
+    with pytest.raises(runtime_config.InvalidConfigError, match=message):
+        runtime_config.load(config_override)
+
+
+def test_numbers_interchangeable():
+    run_config = runtime_config.load({'InSeatTransfers': {'max_wait_time': 450.5, 'similarity_percentile': 1}})
+    assert run_config.InSeatTransfers.max_wait_time == 450.5
+    assert run_config.InSeatTransfers.similarity_percentile == 1
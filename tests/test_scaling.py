@@ -0,0 +1,91 @@
+"""
+Runs many copies of some test feeds as one feed, and checks that the work done, counted by instrumentation, grows at
+most linearly with the number of trips. Unlike timings, counts do not depend on the machine, so an algorithmic
+regression fails deterministically. Select only these tests with pytest -m scaling, or skip them with -m "not scaling".
+"""
+import csv
+import pytest
+from pathlib import Path
+import blocks_to_transfers.processing
+from blocks_to_transfers import config
+from blocks_to_transfers.logs import Warn
+
+pytestmark = pytest.mark.scaling
+
+TEST_DIR = Path(__file__).parent
+NUM_COPIES = 1000
+
+# Maximum of each counter per trip in blocks, from a single copy of each test
+BUDGETS = {
+    'test_multi_day_blocks': {
+        'candidate_pairs': 2.125,
+        'graph_nodes': 0.875,
+        'split_alternatives_requeued': 0.75,
+        'node_splits': 0,
+        'find_paths_transitions': 1,
+        'linear_graph_nodes': 1.375,
+    },
+    'test_full_loops': {
+        'candidate_pairs': 1,
+        'graph_nodes': 1,
+        'split_alternatives_requeued': 0.667,
+        'node_splits': 0,
+        'find_paths_transitions': 1.334,
+        'linear_graph_nodes': 1,
+    },
+    'test_competing_continuations_on_same_day': {
+        'candidate_pairs': 1,
+        'graph_nodes': 1.334,
+        'split_alternatives_requeued': 1.667,
+        'node_splits': 0.334,
+        'find_paths_transitions': 1.667,
+        'linear_graph_nodes': 1.667,
+    },
+}
+
+
+@pytest.mark.parametrize('test_name', BUDGETS)
+def test_work_within_budget(test_name, tmp_path, monkeypatch):
+    monkeypatch.setattr(config.Performance, 'hot_counters', True)
+    single_counters, single_warnings = process_copies(test_name, tmp_path / 'single', 1)
+    counters, warnings = process_copies(test_name, tmp_path / 'scaled', NUM_COPIES)
+
+    num_trips = counters['trips_in_blocks']
+    assert num_trips == NUM_COPIES * single_counters['trips_in_blocks']
+    assert len(warnings) == NUM_COPIES * len(single_warnings)
+    for name, budget in BUDGETS[test_name].items():
+        # Blocks are independent, so each copy must take as much work as the first
+        count = counters.get(name, 0)
+        assert count == NUM_COPIES * single_counters.get(name, 0), name
+        assert count <= budget * num_trips, name
+
+
+def process_copies(test_name, work_dir, num_copies):
+    """
+    Returns the counters and warnings of processing a feed with num_copies of each block of the test, with distinct
+    trip and block ids.
+    """
+    feed_dir = work_dir / 'input'
+    feed_dir.mkdir(parents=True)
+    for path in (TEST_DIR / 'base').iterdir():
+        (feed_dir / path.name).write_bytes(path.read_bytes())
+
+    for path in (TEST_DIR / test_name / 'input').iterdir():
+        with open(path, newline='') as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            rows = list(reader)
+
+        id_columns = [i for i, column in enumerate(header) if column in ('trip_id', 'block_id')]
+        with open(feed_dir / path.name, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            for i_copy in range(num_copies):
+                for row in rows:
+                    writer.writerows([[f'{value}_{i_copy}' if i in id_columns else value
+                                       for i, value in enumerate(row)]])
+
+    with Warn.capture() as warnings:
+        report = blocks_to_transfers.processing.process(feed_dir, work_dir / 'output', use_simplify_linear=True)
+
+    return report.to_dict()['counters'], warnings
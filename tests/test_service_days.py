@@ -0,0 +1,84 @@
+import pickle
+import random
+import types
+import pytest
+from datetime import datetime, timedelta
+from gtfs_loader.schema import ExceptionType
+from blocks_to_transfers.service_days import DaySet, FixedDaySet, ServiceDays
+
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+WIDTH = 400
+
+
+@pytest.fixture
+def day_sets():
+    rng = random.Random(0)
+    return [(rng.getrandbits(WIDTH - 2), rng.getrandbits(WIDTH // 7)) for _ in range(20)]
+
+
+def test_fixed_day_set_matches_day_set(day_sets):
+    Fixed = FixedDaySet.of_width(WIDTH)
+    for a, b in day_sets:
+        for op in ('intersection', 'union', 'difference', 'isdisjoint', 'issuperset', 'isequal'):
+            assert getattr(Fixed(a), op)(Fixed(b)) == getattr(DaySet(a), op)(DaySet(b)), op
+
+        for num_days in (-3, -1, 0, 1, 2):
+            assert Fixed(a).shift(num_days) == DaySet(a).shift(num_days)
+            assert type(Fixed(a).shift(num_days)) is Fixed
+
+        assert list(Fixed(b)) == list(DaySet(b))
+        assert Fixed(b).count() == DaySet(b).count() == len(list(DaySet(b)))
+        assert [Fixed(b)[day] for day in range(WIDTH)] == [DaySet(b)[day] for day in range(WIDTH)]
+
+    assert Fixed(1 << (WIDTH - 1)).shift(1) == 0
+
+
+def test_fixed_day_sets_of_other_widths_unaffected():
+    narrow, wide = FixedDaySet.of_width(10), FixedDaySet.of_width(WIDTH)
+    days = wide(1 << 20)
+    assert narrow(1 << 9).shift(1) == 0
+    assert days.shift(1) == 1 << 21
+    # Day sets are sent to worker processes with their width
+    copy = pickle.loads(pickle.dumps(days))
+    assert type(copy) is wide and copy == days
+
+
+class Calendar(types.SimpleNamespace):
+
+    def __getitem__(self, weekday):
+        return getattr(self, weekday)
+
+
+def test_calendars_expanded_day_by_day():
+    rng = random.Random(0)
+    feed_start = datetime(2024, 1, 1)
+    calendars = {}
+    calendar_dates = {}
+    for i in range(200):
+        start = feed_start + timedelta(days=rng.randint(0, 100))
+        end = start + timedelta(days=rng.randint(-1, 500))
+        calendars[f's{i}'] = Calendar(start_date=start, end_date=end, **{day: rng.randint(0, 1) for day in WEEKDAYS})
+        # Conflicting exceptions on the same date: the last one applies
+        calendar_dates[f's{i}'] = [
+            types.SimpleNamespace(date=feed_start + timedelta(days=rng.randint(0, 20)),
+                                  exception_type=rng.choice([ExceptionType.ADD, ExceptionType.REMOVE]))
+            for _ in range(rng.randint(0, 10))
+        ]
+
+    services = ServiceDays(types.SimpleNamespace(calendar=calendars, calendar_dates=calendar_dates))
+    assert services.epoch == feed_start
+    for service_id, calendar in calendars.items():
+        expected = set()
+        day = calendar.start_date
+        while day <= calendar.end_date:
+            if calendar[WEEKDAYS[day.weekday()]]:
+                expected.add(day)
+            day += timedelta(days=1)
+        for date in calendar_dates[service_id]:
+            if date.exception_type == ExceptionType.ADD:
+                expected.add(date.date)
+            else:
+                expected.discard(date.date)
+
+        assert set(services.to_dates(services.days_by_service[service_id])) == expected
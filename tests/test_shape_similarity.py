@@ -0,0 +1,130 @@
+import random
+import pytest
+from pathlib import Path
+from gtfs_loader.lat_lon import LatLon
+from blocks_to_transfers import shape_similarity, similarity_report
+from blocks_to_transfers.projection import PlanarProjection
+
+
+def random_shape(rng, num_stops):
+    lat, lon = 47.6 + rng.uniform(-0.05, 0.05), -122.3 + rng.uniform(-0.05, 0.05)
+    shape = []
+    for _ in range(num_stops):
+        lat += rng.uniform(-0.003, 0.003)
+        lon += rng.uniform(-0.003, 0.003)
+        shape.append(LatLon(lat, lon))
+    return shape_similarity.StopShape(shape)
+
+
+def planar_shape(shape):
+    projection = PlanarProjection([LatLon(47.6, -122.3)])
+    return shape_similarity.StopShape(projection.project(pt) for pt in shape)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_numpy_engine_matches_python(seed):
+    pytest.importorskip('numpy')
+    rng = random.Random(seed)
+    shape_a = random_shape(rng, rng.randint(2, 60))
+    shape_b = random_shape(rng, rng.randint(2, 60))
+
+    expected = shape_similarity.hausdorff_percentile(shape_a, shape_b, .8)
+    actual = shape_similarity.hausdorff_percentile_numpy(shape_a, shape_b, .8)
+    assert actual == pytest.approx(expected, abs=1e-6)
+
+
+def test_numpy_percentile_matches_percentile():
+    numpy = pytest.importorskip('numpy')
+    rng = random.Random(0)
+    for num_values in range(1, 30):
+        values = [rng.uniform(0, 1000) for _ in range(num_values)]
+        for threshold in (0, .1, .5, .8, .99, 1):
+            assert shape_similarity.percentile_numpy(
+                numpy.array(values),
+                threshold) == shape_similarity.percentile(values, threshold)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_segment_index_matches_exhaustive_search(seed):
+    rng = random.Random(seed)
+    shape = random_shape(rng, rng.randint(20, 150))
+    points = random_shape(rng, 50)
+    index = shape.segment_index
+    assert index is not None
+
+    for pt in points + shape:
+        expected = min(
+            pt.distance_to_segment(l1, l2) for l1, l2 in zip(shape, shape[1:]))
+        assert index.nearest(pt) == expected
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_early_exit_matches_percentile(seed):
+    rng = random.Random(seed)
+    shape_a = random_shape(rng, rng.randint(2, 40))
+    shape_b = random_shape(rng, rng.randint(2, 40))
+
+    for threshold in (0, .5, .8, 1):
+        distance = shape_similarity.hausdorff_percentile(shape_a, shape_b, threshold)
+        for limit in (0, 100, distance, distance * 1.01, 1e9):
+            assert shape_similarity.hausdorff_percentile_below(
+                shape_a, shape_b, threshold, limit) == (distance < limit)
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_simplified_shape_within_tolerance(seed):
+    rng = random.Random(seed)
+    shape = random_shape(rng, 80)
+    simplified = shape.simplified(100)
+
+    assert simplified[0] is shape[0] and simplified[-1] is shape[-1]
+    assert len(simplified) < len(shape)
+    assert max(shape_similarity.distance_point_to_nearest_segment(shape, simplified)) <= 100
+    assert shape.simplified(100) is simplified
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_planar_distances_close_to_spherical(seed):
+    rng = random.Random(seed)
+    shape_a = random_shape(rng, rng.randint(2, 60))
+    shape_b = random_shape(rng, rng.randint(2, 60))
+
+    expected = shape_similarity.hausdorff_percentile(shape_a, shape_b, .8)
+    actual = shape_similarity.hausdorff_percentile(planar_shape(shape_a),
+                                                   planar_shape(shape_b), .8)
+    assert actual == pytest.approx(expected, rel=.005)
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_planar_segment_index_matches_exhaustive_search(seed):
+    rng = random.Random(seed)
+    shape = planar_shape(random_shape(rng, rng.randint(20, 150)))
+    points = planar_shape(random_shape(rng, 50))
+    assert isinstance(shape.segment_index, shape_similarity.PlanarSegmentIndex)
+
+    for pt in points + shape:
+        expected = min(
+            pt.distance_to_segment(l1, l2) for l1, l2 in zip(shape, shape[1:]))
+        assert shape.segment_index.nearest(pt) == expected
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_planar_numpy_engine_matches_python(seed):
+    pytest.importorskip('numpy')
+    rng = random.Random(seed)
+    shape_a = planar_shape(random_shape(rng, rng.randint(2, 60)))
+    shape_b = planar_shape(random_shape(rng, rng.randint(2, 60)))
+
+    expected = shape_similarity.hausdorff_percentile(shape_a, shape_b, .8)
+    actual = shape_similarity.hausdorff_percentile_numpy(shape_a, shape_b, .8)
+    assert actual == pytest.approx(expected, abs=1e-6)
+
+
+def test_similarity_report_on_test_case():
+    # Test cases only hold the files which differ from tests/base
+    test_dir = Path(__file__).parent / 'test_hausdorff_kcm_125'
+    gtfs = similarity_report.load_feed(test_dir)
+    assert (list(gtfs.trips), list(gtfs.agency)) == (['trip_1', 'trip_2'], ['GT'])
+
+    stats = similarity_report.compare_feed(test_dir, .25)
+    assert (stats['pairs'], stats['stops']) == (1, 57)
@@ -0,0 +1,55 @@
+import random
+from blocks_to_transfers import config
+from blocks_to_transfers.similarity_cache import SimilarityCache
+from .test_shape_similarity import random_shape
+
+
+def make_shapes(num_shapes):
+    rng = random.Random(0)
+    return [random_shape(rng, 10) for _ in range(num_shapes)]
+
+
+def test_results_reused_across_runs(tmp_path):
+    shape_a, shape_b, shape_c = make_shapes(3)
+    cache = SimilarityCache(tmp_path / 'cache.db')
+    assert cache.get(shape_a, shape_b) is None
+    cache.put(shape_a, shape_b, True)
+    cache.put(shape_b, shape_c, False)
+    cache.close()
+
+    cache = SimilarityCache(tmp_path / 'cache.db')
+    assert cache.get(shape_b, shape_a) is True
+    assert cache.get(shape_c, shape_b) is False
+    assert (cache.hits, cache.misses) == (2, 0)
+    cache.close()
+
+
+def test_invalidated_by_config_change(tmp_path, monkeypatch):
+    shape_a, shape_b = make_shapes(2)
+    cache = SimilarityCache(tmp_path / 'cache.db')
+    cache.put(shape_a, shape_b, True)
+    cache.close()
+
+    monkeypatch.setattr(config.InSeatTransfers, 'similarity_distance', 200)
+    cache = SimilarityCache(tmp_path / 'cache.db')
+    assert cache.get(shape_a, shape_b) is None
+    cache.close()
+
+
+def test_least_recently_used_evicted(tmp_path):
+    shapes = make_shapes(4)
+    cache = SimilarityCache(tmp_path / 'cache.db', max_entries=2)
+    cache.put(shapes[0], shapes[1], True)
+    cache.put(shapes[1], shapes[2], True)
+    cache.close()
+
+    cache = SimilarityCache(tmp_path / 'cache.db', max_entries=2)
+    cache.get(shapes[0], shapes[1])
+    cache.put(shapes[2], shapes[3], False)
+    cache.close()
+
+    cache = SimilarityCache(tmp_path / 'cache.db', max_entries=2)
+    assert cache.get(shapes[0], shapes[1]) is True
+    assert cache.get(shapes[1], shapes[2]) is None
+    assert cache.get(shapes[2], shapes[3]) is False
+    cache.close()
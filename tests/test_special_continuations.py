@@ -0,0 +1,52 @@
+import collections
+import types
+import pytest
+from gtfs_loader.schema import TransferType
+from blocks_to_transfers import classify_transfers, runtime_config
+
+
+def make_trip(route, first_stop, last_stop):
+    return types.SimpleNamespace(route=types.SimpleNamespace(route_short_name=route),
+                                 first_stop=types.SimpleNamespace(stop_name=first_stop),
+                                 last_stop=types.SimpleNamespace(stop_name=last_stop))
+
+
+def load_rules(rules, banned_stops=()):
+    return runtime_config.load({
+        'InSeatTransfers': {'banned_stops': list(banned_stops)},
+        'SpecialContinuations': rules
+    }).rule_index
+
+
+def get_result(rule_index, trip, cont_trip):
+    rule_stats = collections.Counter()
+    return classify_transfers.get_specific_cases_result(rule_index, rule_stats, trip, cont_trip), rule_stats
+
+
+def test_last_matching_rule_wins():
+    rule_index = load_rules([
+        {'match': [{'all': True}], 'op': 'modify', 'transfer_type': 5},
+        {'match': [{'from': {'route': '1'}, 'to': {'first_stop': 'Depot'}}], 'op': 'modify', 'transfer_type': 4},
+        {'match': [{'through': {'route': '2', 'stop': 'Centre'}}], 'op': 'modify', 'transfer_type': 104},
+    ], banned_stops=['Airport'])
+    trip = make_trip('1', 'Airport', 'Centre')
+
+    assert get_result(rule_index, trip, make_trip('1', 'Depot', 'Airport')) == (TransferType.IN_SEAT, {1: 1})
+    assert get_result(rule_index, trip, make_trip('2', 'Centre', 'Depot')) == (104, {2: 1})
+    # The trip's first stop and the continuation's last stop are not the stops of the transfer
+    assert get_result(rule_index, trip, make_trip('3', 'Mall', 'Airport')) == (TransferType.VEHICLE_CONTINUATION,
+                                                                               {0: 1})
+    assert get_result(rule_index, make_trip('3', 'Mall', 'Airport'), trip) == (TransferType.VEHICLE_CONTINUATION,
+                                                                               {3: 1})
+
+
+def test_invalid_rules_rejected_once_loaded():
+    with pytest.raises(classify_transfers.InvalidRuleError, match='has no selector criteria'):
+        load_rules([{'match': [{'to': {'route': None}}, {'through': {}}], 'op': 'modify', 'transfer_type': 4}])
+
+    with pytest.raises(classify_transfers.InvalidRuleError, match='no selectors'):
+        load_rules([{'match': [], 'op': 'modify', 'transfer_type': 4}])
+
+    # Operations which are not implemented are ignored
+    rule_index = load_rules([{'match': [], 'op': 'remove'}])
+    assert get_result(rule_index, make_trip('1', 'A', 'B'), make_trip('1', 'B', 'A')) == (None, {})
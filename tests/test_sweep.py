@@ -0,0 +1,58 @@
+import csv
+import collections
+import pytest
+from gtfs_loader import test_support
+import blocks_to_transfers
+
+test_support.init(__file__)
+CONFIGS = {
+    'default': {},
+    'short_wait': {'InSeatTransfers': {'max_wait_time': 60}},
+    'never_split': {'TripToTripTransfers': {'max_wait_time': 0}},
+    'lenient_similarity': {'InSeatTransfers': {'similarity_percentile': .5, 'similarity_distance': 1000}},
+}
+
+
+@pytest.mark.parametrize('service_window', [None, '20210301:20210314'])
+def test_summaries_match_processing(tmp_path, service_window):
+    feed_dir = test_support.create_test_data(test_support.TEST_DIR / 'test_competing_continuations_on_same_day')
+    # A trip outside of any block, which is only clipped to the window
+    with open(feed_dir / 'trips.txt', 'a') as f:
+        f.write('99,unblocked,mon,\n')
+    with open(feed_dir / 'stop_times.txt') as f:
+        stop_times = [line.replace('trip_1,', 'unblocked,', 1) for line in f if line.startswith('trip_1,')]
+    with open(feed_dir / 'stop_times.txt', 'a') as f:
+        f.writelines(stop_times)
+    summaries = blocks_to_transfers.sweep_configs(feed_dir, CONFIGS, service_window=service_window)
+
+    assert [summary['name'] for summary in summaries] == list(CONFIGS)
+    for summary, (name, config_override) in zip(summaries, CONFIGS.items()):
+        out_dir = tmp_path / name
+        blocks_to_transfers.process_with_config(feed_dir, out_dir, config_override, service_window=service_window)
+        with open(out_dir / 'transfers.txt') as f:
+            transfers = collections.Counter(transfer['transfer_type'] for transfer in csv.DictReader(f)
+                                            if transfer['from_trip_id'] and transfer['to_trip_id'])
+        with open(out_dir / 'trips.txt') as f:
+            trips = list(csv.DictReader(f))
+
+        assert summary['transfers'] == dict(sorted(transfers.items())), name
+        assert summary['split_trips'] == sum('_b2t:if_' in trip['trip_id'] for trip in trips), name
+        assert summary['clipped_trips'] == sum('_b2t:if_' not in trip['trip_id'] and
+                                               trip['service_id'].startswith('b2t:service_') for trip in trips), name
+        assert summary['synthetic_services'] == len(
+            {trip['service_id'] for trip in trips if trip['service_id'].startswith('b2t:service_')}), name
+
+    # Shapes are compared once for both configurations with the default similarity options
+    assert summaries[0]['shape_comparisons'] > 0
+    assert summaries[1]['shape_comparisons'] == 0
+    assert summaries[0]['split_trips'] > summaries[2]['split_trips'] == 0
+    assert (summaries[0]['clipped_trips'] > 0) == (service_window is not None)
+
+
+def test_list_of_configs():
+    feed_dir = test_support.create_test_data(test_support.TEST_DIR / 'test_full_loops')
+    summaries = blocks_to_transfers.sweep_configs(feed_dir, [{}, {'InSeatTransfers': {'max_wait_time': -1}}])
+
+    assert [summary['name'] for summary in summaries] == ['0', '1']
+    assert summaries[0]['transfers'] != summaries[1]['transfers']
+    assert set(summaries[1]['transfers']) == {'5'}
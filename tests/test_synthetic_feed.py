@@ -0,0 +1,59 @@
+import filecmp
+import pickle
+import gtfs_loader
+import blocks_to_transfers.processing
+from blocks_to_transfers import config, synthetic_feed, benchmark, simplify_graph
+
+TINY = synthetic_feed.FeedParams(num_blocks=20, trips_per_block=6, stops_per_trip=5)
+
+
+def test_feed_deterministic(tmp_path):
+    synthetic_feed.generate(tmp_path / 'a', TINY, seed=1)
+    synthetic_feed.generate(tmp_path / 'b', TINY, seed=1)
+    files = ['trips.txt', 'stop_times.txt', 'transfers.txt']
+    _, mismatch, errors = filecmp.cmpfiles(tmp_path / 'a', tmp_path / 'b', files, shallow=False)
+    assert not mismatch and not errors
+
+
+def test_feed_processed(tmp_path):
+    synthetic_feed.generate(tmp_path / 'feed', TINY)
+    report = blocks_to_transfers.processing.process(str(tmp_path / 'feed'), str(tmp_path / 'out'),
+                                                    use_simplify_linear=True).to_dict()
+    assert report['counters']['blocks'] == TINY.num_blocks
+    assert report['counters']['transfers_generated'] > 0
+
+
+def test_components_simplified_in_workers(tmp_path, monkeypatch):
+    synthetic_feed.generate(tmp_path / 'feed', TINY)
+    serial = blocks_to_transfers.processing.process(str(tmp_path / 'feed'), str(tmp_path / 'serial')).to_dict()
+    monkeypatch.setattr(config.Performance, 'simplify_jobs', 2)
+    parallel = blocks_to_transfers.processing.process(str(tmp_path / 'feed'), str(tmp_path / 'parallel')).to_dict()
+
+    assert serial['counters']['graph_components'] > 1
+    for name in ('graph_components', 'graph_nodes', 'node_splits'):
+        assert serial['counters'].get(name) == parallel['counters'].get(name), name
+    files = ['trips.txt', 'stop_times.txt', 'transfers.txt', 'calendar_dates.txt']
+    _, mismatch, errors = filecmp.cmpfiles(tmp_path / 'serial', tmp_path / 'parallel', files, shallow=False)
+    assert not mismatch and not errors
+
+
+def test_trips_sent_to_workers_without_feed(tmp_path):
+    synthetic_feed.generate(tmp_path / 'feed', TINY)
+    gtfs = gtfs_loader.load(str(tmp_path / 'feed'))
+    trip = next(iter(gtfs.trips.values()))
+
+    sent = pickle.loads(pickle.dumps(simplify_graph.WorkerTrip(trip)))
+    assert len(pickle.dumps(sent)) < 500
+    assert (sent.trip_id, sent.service_id, sent['block_id']) == (trip.trip_id, trip.service_id, trip.block_id)
+    assert (sent.shift_days, sent.first_departure, sent.last_arrival) == (trip.shift_days, trip.first_departure,
+                                                                          trip.last_arrival)
+
+
+def test_regressions_found():
+    baseline = {'small': {'wall_time_s': 1.0, 'peak_rss_mb': 50, 'stages': {'load': 0.5, 'patch': 0.01},
+                          'counters': {'node_splits': 10}}}
+    results = {'small': {'wall_time_s': 1.1, 'peak_rss_mb': 80, 'stages': {'load': 0.7, 'patch': 0.05},
+                         'counters': {'node_splits': 10}}}
+    regressions = list(benchmark.find_regressions(baseline, results, threshold=0.25))
+    assert [(preset, measure) for preset, measure, _, _ in regressions] == [('small', 'peak_rss_mb'),
+                                                                            ('small', 'stages.load')]